@@ -0,0 +1,274 @@
+"""
+An in-process stand-in for a Wikibase: the api.php actions and the sparql query shapes that Krusty and
+wikidataintegrator use. Entities are kept in memory and the sparql results are computed from them.
+Only meant for benchmarking, it doesn't validate much.
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+ENTITY_URI = "http://wikibase.svc/entity/"
+EQUIVALENT_PROPERTY = "http://www.w3.org/2002/07/owl#equivalentProperty"
+
+
+class FakeWikibase:
+    def __init__(self, latency=0, sparql_lag=0):
+        # latency: seconds added to every api.php call, to simulate a remote wikibase
+        # sparql_lag: entities modified less than this many seconds ago aren't visible to sparql yet
+        self.latency = latency
+        self.sparql_lag = sparql_lag
+        self.entities = dict()
+        self.modified = dict()
+        # {pid: {value: {entity id}}}, for the sparql lookups by value
+        self.index = defaultdict(lambda: defaultdict(set))
+        self.next_id = {'item': 1, 'property': 1}
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int)
+
+    # api.php
+
+    def api(self, params):
+        action = params.get('action')
+        with self.lock:
+            self.calls[action] += 1
+        if action == 'fakestats':
+            return self.stats()
+        if self.latency:
+            time.sleep(self.latency)
+        if action == 'login':
+            if 'lgtoken' not in params:
+                return {'login': {'result': 'NeedToken', 'token': 'logintoken'}}
+            return {'login': {'result': 'Success', 'lgusername': params.get('lgname')}}
+        if action == 'query' and params.get('meta') == 'tokens':
+            return {'query': {'tokens': {'csrftoken': '+\\', 'logintoken': 'logintoken'}}}
+        if action == 'wbgetentities':
+            return self.get_entities(params['ids'].split("|"))
+        if action == 'wbsearchentities':
+            return self.search_entities(params)
+        if action == 'wbeditentity':
+            return self.edit_entity(params)
+        return {'error': {'code': 'badvalue', 'info': 'unsupported action: {}'.format(action)}}
+
+    def stats(self):
+        with self.lock:
+            n_claims = sum(len(claims) for entity in self.entities.values() for claims in entity['claims'].values())
+            return {'calls': dict(self.calls), 'entities': len(self.entities), 'claims': n_claims}
+
+    def get_entities(self, ids):
+        with self.lock:
+            entities = {x: json.loads(json.dumps(self.entities[x])) if x in self.entities else {'id': x, 'missing': ''}
+                        for x in ids}
+        return {'entities': entities, 'success': 1}
+
+    def search_entities(self, params):
+        # label prefix search. like wikibase's term store, it is up to date as soon as an edit is saved
+        search = params['search'].lower()
+        lang = params.get('language', 'en')
+        entity_type = params.get('type', 'item')
+        with self.lock:
+            hits = [eid for eid, entity in self.entities.items() if entity['type'] == entity_type and
+                    entity['labels'].get(lang, dict()).get('value', '').lower().startswith(search)]
+        return {'search': [{'id': eid} for eid in hits[:int(params.get('limit', 7))]], 'success': 1}
+
+    def edit_entity(self, params):
+        data = json.loads(params['data'])
+        with self.lock:
+            if 'new' in params:
+                entity_type = params['new']
+                eid = ("Q" if entity_type == 'item' else "P") + str(self.next_id[entity_type])
+                self.next_id[entity_type] += 1
+                entity = {'id': eid, 'type': entity_type, 'labels': {}, 'descriptions': {}, 'aliases': {},
+                          'claims': {}, 'sitelinks': {}, 'lastrevid': 0}
+                if entity_type == 'property':
+                    entity['datatype'] = data.get('datatype', 'string')
+            else:
+                eid = params['id']
+                if eid not in self.entities:
+                    return {'error': {'code': 'no-such-entity', 'info': eid}}
+                entity = self.entities[eid]
+                if 'baserevid' in params and int(params['baserevid']) != entity['lastrevid']:
+                    return {'error': {'code': 'editconflict', 'info': 'Edit conflict.'}}
+            # as in wikibase, an empty value or alias list removes the language's term
+            for key in ('labels', 'descriptions'):
+                for lang, term in data.get(key, dict()).items():
+                    if term.get('value'):
+                        entity[key][lang] = term
+                    else:
+                        entity[key].pop(lang, None)
+            for lang, aliases in data.get('aliases', dict()).items():
+                entity['aliases'][lang] = [x for x in aliases if 'remove' not in x]
+                if not entity['aliases'][lang]:
+                    del entity['aliases'][lang]
+            claims = data.get('claims', dict())
+            if isinstance(claims, list):
+                claims = {'': claims}
+            for claim_list in claims.values():
+                for claim in claim_list:
+                    self._apply_claim(entity, eid, claim)
+            self._touch(entity)
+            return {'success': 1, 'entity': json.loads(json.dumps(entity))}
+
+    def _apply_claim(self, entity, eid, claim):
+        if 'remove' in claim:
+            for pid, claims in list(entity['claims'].items()):
+                entity['claims'][pid] = [x for x in claims if x['id'] != claim['id']]
+                if not entity['claims'][pid]:
+                    del entity['claims'][pid]
+            return
+        claims = entity['claims'].setdefault(claim['mainsnak']['property'], [])
+        for ref in claim.get('references', []):
+            # wikibase keeps one snaks-order entry per property
+            ref['snaks-order'] = list(dict.fromkeys(ref.get('snaks-order', ref['snaks'])))
+            ref['hash'] = hashlib.sha1(json.dumps(ref['snaks'], sort_keys=True).encode()).hexdigest()
+        if claim.get('id'):
+            for n, old in enumerate(claims):
+                if old['id'] == claim['id']:
+                    claims[n] = claim
+                    return
+        else:
+            claim['id'] = "{}${}".format(eid, uuid.uuid4())
+        claims.append(claim)
+
+    def _touch(self, entity):
+        eid = entity['id']
+        if eid in self.entities:
+            for pid, value in self._entity_values(self.entities[eid]):
+                self.index[pid][value].discard(eid)
+        entity['lastrevid'] += 1
+        entity['modified'] = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.entities[eid] = entity
+        self.modified[eid] = datetime.utcnow()
+        for pid, value in self._entity_values(entity):
+            self.index[pid][value].add(eid)
+
+    # sparql
+
+    def sparql(self, query):
+        with self.lock:
+            self.calls['sparql'] += 1
+            return {'results': {'bindings': self._sparql(query)}}
+
+    def _sparql(self, query):
+        if EQUIVALENT_PROPERTY in query and "directClaim" in query:
+            # the property that is its own equivalent property
+            return [{'item': {'value': ENTITY_URI + pid}, 'prop': {'value': "http://wikibase.svc/prop/direct/" + pid}}
+                    for pid in self._lookup(None, EQUIVALENT_PROPERTY) if pid in self._lookup(pid, EQUIVALENT_PROPERTY)]
+
+        m = re.search(r'\?item schema:dateModified \?mod \.\s*FILTER\s*\(\?mod >= "(.*?)"', query)
+        if m:
+            # the entities modified since a time, with their values of a property if they have any
+            since = datetime.strptime(m.group(1), '%Y-%m-%dT%H:%M:%SZ')
+            pid = re.search(r"p:(P\d+)", query).group(1)
+            bindings = []
+            for eid, entity in self.entities.items():
+                if self.modified[eid] < since or not self._visible(eid):
+                    continue
+                values = [self._snak_value(x['mainsnak']) for x in entity['claims'].get(pid, [])]
+                bindings.extend({'item': {'value': ENTITY_URI + eid}, 'id': {'value': v}} for v in values)
+                if not values:
+                    bindings.append({'item': {'value': ENTITY_URI + eid}})
+            return bindings
+
+        if re.search(r"schema:dateModified \?d", query):
+            # when the endpoint was last updated
+            return [{'d': {'value': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')}}]
+
+        m = re.search(r"\?(item|item_id) p:(P\d+) \?s \s*\.\s*\?s ps:\2 (\?id|'(.*)'|wd:Q(\d+)) \.", query)
+        if m:
+            # id_mapper (all values of a property) or the item engine's lookup of an item by a value
+            var, pid, _, str_value, qid_value = m.groups()
+            if str_value is not None or qid_value is not None:
+                value = str_value if str_value is not None else 'Q' + qid_value
+                return [{var: {'value': ENTITY_URI + eid}, 'id': {'value': value}} for eid in
+                        sorted(self._lookup(pid, value))]
+            return [{var: {'value': ENTITY_URI + eid}, 'id': {'value': value}} for value, eids in
+                    self.index[pid].items() for eid in sorted(eids) if self._visible(eid)]
+        return []
+
+    def _lookup(self, pid, value):
+        # visible entities with this value for pid (or for any property if pid is None)
+        indexes = [self.index[pid]] if pid else list(self.index.values())
+        return {eid for index in indexes for eid in index.get(value, ()) if self._visible(eid)}
+
+    def _visible(self, eid):
+        return not self.sparql_lag or (datetime.utcnow() - self.modified[eid]).total_seconds() >= self.sparql_lag
+
+    def _entity_values(self, entity):
+        return [(pid, self._snak_value(claim['mainsnak'])) for pid, claims in entity['claims'].items()
+                for claim in claims]
+
+    @staticmethod
+    def _snak_value(snak):
+        value = snak.get('datavalue', dict()).get('value')
+        if isinstance(value, dict):
+            return "Q{}".format(value['numeric-id'])
+        return value
+
+
+def make_handler(wikibase):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # the headers and the body are sent separately. without this, each reply waits for a delayed ack
+        disable_nagle_algorithm = True
+
+        def _params(self):
+            params = parse_qs(urlparse(self.path).query)
+            if self.command == 'POST':
+                length = int(self.headers.get('Content-Length', 0))
+                params.update(parse_qs(self.rfile.read(length).decode()))
+            return {k: v[0] for k, v in params.items()}
+
+        def _handle(self):
+            params = self._params()
+            if urlparse(self.path).path.endswith("sparql"):
+                body = wikibase.sparql(params['query'])
+            else:
+                body = wikibase.api(params)
+            payload = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = do_POST = _handle
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def bootstrap(wikibase):
+    # what the wikibase setup does: P1 'equivalent class' and P2 'equivalent property'. wd_to_neo4j expects P2
+    for label in ["equivalent class", "equivalent property"]:
+        wikibase.edit_entity({'new': 'property', 'data': json.dumps({
+            'labels': {'en': {'language': 'en', 'value': label}}, 'datatype': 'url'})})
+    for pid, uri in [("P1", "http://www.w3.org/2002/07/owl#equivalentClass"), ("P2", EQUIVALENT_PROPERTY)]:
+        wikibase.edit_entity({'id': pid, 'data': json.dumps({'claims': {'P2': [{
+            'mainsnak': {'snaktype': 'value', 'property': 'P2', 'datatype': 'url',
+                         'datavalue': {'value': uri, 'type': 'string'}},
+            'type': 'statement', 'rank': 'normal'}]}})})
+
+
+def serve(wikibase=None, port=0):
+    # returns (wikibase, server, mediawiki_api_url, sparql_endpoint_url)
+    if wikibase is None:
+        wikibase = FakeWikibase()
+        bootstrap(wikibase)
+    server = ThreadingServer(("127.0.0.1", port), make_handler(wikibase))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:{}".format(server.server_address[1])
+    return wikibase, server, base + "/w/api.php", base + "/sparql"
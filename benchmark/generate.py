@@ -0,0 +1,106 @@
+"""
+Generate synthetic nodes and edges csvs in the format neo4j_to_wd.py reads, shaped like the NGLY1 graph: a few node
+types, edges from a skewed degree distribution, skos:exactMatch edges to external ids, several rows (references) per
+statement, long supporting texts and pubmed urls with many pmids.
+"""
+import csv
+import gzip
+import random
+from itertools import accumulate
+
+import configargparse
+
+NODE_COLUMNS = ['id:ID', ':LABEL', 'preflabel', 'synonyms:IGNORE', 'name', 'description']
+EDGE_COLUMNS = [':START_ID', ':TYPE', ':END_ID', 'reference_uri', 'reference_supporting_text', 'reference_date',
+                'property_label', 'property_description:IGNORE', 'property_uri']
+NODE_TYPES = [("gene", "HGNC"), ("protein", "UniProt"), ("disease", "DOID"), ("phenotype", "HP"),
+              ("biological_process", "GO"), ("chemical", "CHEBI")]
+EXACT_MATCH = ("skos:exactMatch", "exact match", "http://www.w3.org/2004/02/skos/core#exactMatch")
+PUBMED_URL = "https://www.ncbi.nlm.nih.gov/pubmed/"
+
+
+def open_csv(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    return opener(path, "wt", newline="", encoding="utf-8")
+
+
+def make_props(n):
+    # (curie, label, uri), like the RO relations of the NGLY1 graph
+    return [("RO:{:07d}".format(2000 + i), "relation {}".format(i),
+             "http://purl.obolibrary.org/obo/RO_{:07d}".format(2000 + i)) for i in range(n)]
+
+
+def make_text(r, mean_words):
+    # a supporting text of about mean_words words, empty for a tenth of the rows
+    if not mean_words or r.random() < .1:
+        return ""
+    n_words = max(1, int(r.expovariate(1 / mean_words)))
+    return " ".join("word{}".format(r.randrange(5000)) for _ in range(n_words))
+
+
+def make_ref_uri(r, max_pmids, extra_url_fraction, n):
+    # a pubmed url with up to max_pmids pmids (longer than 400 chars past ~45), sometimes with a second url
+    pmids = [str(r.randrange(10 ** 7, 10 ** 8)) for _ in range(r.randint(1, max_pmids))]
+    uri = PUBMED_URL + ",".join(pmids)
+    if r.random() < extra_url_fraction:
+        uri += "|http://example.org/source/{}".format(n)
+    return uri
+
+
+def generate(node_path, edge_path, nodes=1000, edges=5000, props=10, degree_alpha=1.0, exact_match_fraction=.1,
+             dupe_label_fraction=.01, multi_ref_fraction=.2, mean_text_words=50, max_pmids=80,
+             extra_url_fraction=.3, seed=0):
+    r = random.Random(seed)
+    node_ids = []
+    with open_csv(node_path) as f:
+        writer = csv.writer(f)
+        writer.writerow(NODE_COLUMNS)
+        for i in range(nodes):
+            node_type, prefix = NODE_TYPES[i % len(NODE_TYPES)]
+            node_id = "{}:{:07d}".format(prefix, i)
+            node_ids.append(node_id)
+            # some nodes share a label, which neo4j_to_wd.py disambiguates with the id
+            label = "{} {}".format(node_type, r.randrange(nodes) if r.random() < dupe_label_fraction else i)
+            writer.writerow([node_id, node_type, label, "{} synonym|{} alias".format(label, node_id),
+                             "{} name".format(label), "a synthetic {}".format(node_type)])
+
+    # node i is picked with weight 1 / (i + 1) ** degree_alpha. 0 is uniform
+    cum_weights = list(accumulate(1 / (i + 1) ** degree_alpha for i in range(nodes)))
+    prop_list = make_props(props)
+    n = 0
+    with open_csv(edge_path) as f:
+        writer = csv.writer(f)
+        writer.writerow(EDGE_COLUMNS)
+        while n < edges:
+            start, end = r.choices(node_ids, cum_weights=cum_weights, k=2)
+            if r.random() < exact_match_fraction:
+                prop = EXACT_MATCH
+                end = "MESH:D{:06d}".format(r.randrange(nodes * 10))
+            else:
+                prop = r.choice(prop_list)
+            # the same (start, type, end) on several rows gives a statement with several references
+            n_refs = 1 + int(r.expovariate(1)) if r.random() < multi_ref_fraction else 1
+            for _ in range(min(n_refs, edges - n)):
+                writer.writerow([start, prop[0], end, make_ref_uri(r, max_pmids, extra_url_fraction, n),
+                                 make_text(r, mean_text_words), "", prop[1], "", prop[2]])
+                n += 1
+
+
+if __name__ == '__main__':
+    p = configargparse.ArgParser()
+    p.add("--node-path", required=True, help="path to write the nodes csv to (gzipped if it ends with .gz)")
+    p.add("--edge-path", required=True, help="path to write the edges csv to (gzipped if it ends with .gz)")
+    p.add("--nodes", type=int, default=1000, help="number of nodes")
+    p.add("--edges", type=int, default=5000, help="number of edge rows")
+    p.add("--props", type=int, default=10, help="number of item valued edge types")
+    p.add("--degree-alpha", type=float, default=1.0,
+          help="exponent of the power law edge endpoints are drawn from. 0 is uniform")
+    p.add("--exact-match-fraction", type=float, default=.1, help="fraction of skos:exactMatch (string) edges")
+    p.add("--dupe-label-fraction", type=float, default=.01, help="fraction of nodes with a label used elsewhere")
+    p.add("--multi-ref-fraction", type=float, default=.2, help="fraction of statements with several references")
+    p.add("--mean-text-words", type=int, default=50, help="mean number of words in reference supporting texts")
+    p.add("--max-pmids", type=int, default=80, help="maximum number of pmids in a pubmed reference url")
+    p.add("--extra-url-fraction", type=float, default=.3, help="fraction of references with a second url")
+    p.add("--seed", type=int, default=0, help="random seed")
+    options, _ = p.parse_known_args()
+    generate(**options.__dict__)
@@ -0,0 +1,212 @@
+"""
+Benchmark neo4j_to_wd.py and wd_to_neo4j.py end to end against the fake wikibase in fake_wikibase.py.
+Generates a synthetic graph (see generate.py), syncs it into an empty fake wikibase, optionally syncs it again
+(nothing to do the second time) and exports it back. Reports items/s, statements/s, peak RSS, per-stage timings
+and the api calls made.
+The fake runs in its own process, and so does each phase, so timings and peak RSS are the bot's only.
+"""
+import csv
+import gzip
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import configargparse
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from wikidataintegrator import wdi_core, wdi_login
+
+import fake_wikibase
+import generate
+import neo4j_to_wd
+import wd_to_neo4j
+from metrics import Metrics
+
+# the item engine looks up the distinct value properties and external id databases of wikidata.org when it's made.
+# none of them apply to the fake wikibase, and the benchmark shouldn't go online
+wdi_core.WDItemEngine.DISTINCT_VALUE_PROPS['https://query.wikidata.org/sparql'] = set()
+wdi_core.WDItemEngine.databases = {'none': []}
+
+
+def serve_fake(conn, latency):
+    wikibase = fake_wikibase.FakeWikibase(latency=latency)
+    fake_wikibase.bootstrap(wikibase)
+    _, server, api_url, sparql_url = fake_wikibase.serve(wikibase)
+    conn.send((api_url, sparql_url))
+    # serve until terminated
+    conn.recv()
+
+
+def fake_stats(api_url):
+    return requests.get(api_url, params={'action': 'fakestats', 'format': 'json'}).json()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def sync(api_url, sparql_url, node_path, edge_path, metrics, **kwargs):
+    login = wdi_login.WDLogin(user="benchmark", pwd="benchmark", mediawiki_api_url=api_url)
+    bot = neo4j_to_wd.Bot(node_path, edge_path, api_url, sparql_url, login, metrics=metrics, quiet=True, **kwargs)
+    bot.run()
+
+
+def export(api_url, sparql_url, node_path, edge_path, metrics, **kwargs):
+    bot = wd_to_neo4j.Bot(sparql_url, api_url, node_path, edge_path, metrics=metrics, quiet=True, **kwargs)
+    bot.run()
+
+
+def run_phase(conn, f, api_url, sparql_url, node_path, edge_path, log_path, kwargs):
+    # what the bots and wikidataintegrator still print goes to the phase's log
+    log = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    metrics = Metrics(f.__name__)
+    t = time.perf_counter()
+    f(api_url, sparql_url, node_path, edge_path, metrics, **kwargs)
+    total = time.perf_counter() - t
+    snapshot = metrics.snapshot()
+    timings = {x['labels']['stage']: x['sum'] for x in snapshot['histograms'] if x['name'] == "stage_seconds"}
+    timings['total'] = total
+    conn.send({'timings': timings, 'peak_rss_mb': peak_rss_mb(), 'metrics': snapshot})
+
+
+def phase(ctx, name, f, api_url, sparql_url, node_path, edge_path, work_dir, **kwargs):
+    log_path = os.path.join(work_dir, name + ".log")
+    before = fake_stats(api_url)['calls']
+    parent_conn, child_conn = ctx.Pipe()
+    p = ctx.Process(target=run_phase, args=(child_conn, f, api_url, sparql_url, node_path, edge_path, log_path,
+                                            kwargs))
+    p.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = None
+    p.join()
+    if p.exitcode or result is None:
+        raise RuntimeError("{} failed, see {}".format(name, log_path))
+    after = fake_stats(api_url)['calls']
+    result['calls'] = {k: v - before.get(k, 0) for k, v in sorted(after.items())
+                       if k != 'fakestats' and v - before.get(k, 0)}
+    return result
+
+
+def count_graph(node_path, edge_path):
+    # nodes, edge rows and distinct statements (start, type, end) in the generated csvs
+    with gzip.open(node_path, "rt") as f:
+        n_nodes = sum(1 for _ in f) - 1
+    spo = set()
+    n_rows = 0
+    with gzip.open(edge_path, "rt") as f:
+        for row in csv.DictReader(f):
+            spo.add((row[':START_ID'], row[':TYPE'], row[':END_ID']))
+            n_rows += 1
+    return {'nodes': n_nodes, 'edge_rows': n_rows, 'statements': len(spo)}
+
+
+def rate(n, seconds):
+    return round(n / seconds, 1) if seconds else None
+
+
+def report(graph, results):
+    print("graph: {nodes} nodes, {edge_rows} edge rows, {statements} statements".format(**graph))
+    for name, result in results.items():
+        timings = result['timings']
+        print("\n{}: {:.1f}s, peak RSS {:.0f} MB".format(name, timings['total'], result['peak_rss_mb']))
+        for stage, seconds in timings.items():
+            if stage != 'total':
+                print("  {:<16}{:>9.2f}s".format(stage, seconds))
+        for metric, value in result['rates'].items():
+            print("  {:<16}{:>10}".format(metric, value))
+        print("  api calls: " + ", ".join("{} {}".format(k, v) for k, v in result['calls'].items()))
+        # as seen by the bot, for the calls made with its own sessions
+        latency = [x for x in result['metrics']['histograms'] if x['name'] == "api_request_seconds"]
+        if latency:
+            print("  mean latency: " + ", ".join("{} {:.1f}ms".format(x['labels']['action'],
+                                                                      1000 * x['sum'] / x['count']) for x in latency))
+
+
+def main(work_dir=None, nodes=1000, edges=5000, degree_alpha=1.0, mean_text_words=50, max_pmids=80, seed=0,
+         latency=0, concurrency=1, chunksize=None, entity_cache=False, id_store=False, resync=False, chunk_size=50,
+         fetch_workers=4, processes=1, json_out=None):
+    work_dir = work_dir or tempfile.mkdtemp(prefix="krusty-benchmark-")
+    os.makedirs(work_dir, exist_ok=True)
+    node_path = os.path.join(work_dir, "nodes.csv.gz")
+    edge_path = os.path.join(work_dir, "edges.csv.gz")
+    generate.generate(node_path, edge_path, nodes=nodes, edges=edges, degree_alpha=degree_alpha,
+                      mean_text_words=mean_text_words, max_pmids=max_pmids, seed=seed)
+    graph = count_graph(node_path, edge_path)
+
+    sync_kwargs = {'concurrency': concurrency, 'chunksize': chunksize}
+    if entity_cache:
+        sync_kwargs['entity_cache_path'] = os.path.join(work_dir, "entity_cache.sqlite")
+    if id_store:
+        sync_kwargs['id_store_path'] = os.path.join(work_dir, "id_store.sqlite")
+    export_kwargs = {'chunk_size': chunk_size, 'fetch_workers': fetch_workers, 'processes': processes}
+
+    ctx = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = ctx.Pipe()
+    fake = ctx.Process(target=serve_fake, args=(child_conn, latency), daemon=True)
+    fake.start()
+    api_url, sparql_url = parent_conn.recv()
+    try:
+        results = dict()
+        results['sync'] = phase(ctx, "sync", sync, api_url, sparql_url, node_path, edge_path, work_dir,
+                                **sync_kwargs)
+        if resync:
+            results['resync'] = phase(ctx, "resync", sync, api_url, sparql_url, node_path, edge_path, work_dir,
+                                      **sync_kwargs)
+        results['export'] = phase(ctx, "export", export, api_url, sparql_url,
+                                  os.path.join(work_dir, "out_nodes.csv.gz"),
+                                  os.path.join(work_dir, "out_edges.csv.gz"), work_dir, **export_kwargs)
+    finally:
+        fake.terminate()
+
+    for name in ('sync', 'resync'):
+        if name in results:
+            timings = results[name]['timings']
+            results[name]['rates'] = {'items/s': rate(graph['nodes'], timings.get('nodes')),
+                                      'statements/s': rate(graph['statements'], timings.get('edges'))}
+    timings = results['export']['timings']
+    with gzip.open(os.path.join(work_dir, "out_edges.csv.gz"), "rt") as f:
+        out_rows = sum(1 for _ in f) - 1
+    results['export']['rates'] = {'items/s': rate(graph['nodes'], timings['export']),
+                                  'edge rows/s': rate(out_rows, timings['export'])}
+
+    report(graph, results)
+    print("\nfiles and logs in " + work_dir)
+    if json_out:
+        with open(json_out, "w") as f:
+            json.dump({'graph': graph, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    p = configargparse.ArgParser()
+    p.add("--work-dir", help="directory for the generated csvs, exports and logs. a new temp dir by default")
+    p.add("--nodes", type=int, default=1000, help="number of nodes")
+    p.add("--edges", type=int, default=5000, help="number of edge rows")
+    p.add("--degree-alpha", type=float, default=1.0,
+          help="exponent of the power law edge endpoints are drawn from. 0 is uniform")
+    p.add("--mean-text-words", type=int, default=50, help="mean number of words in reference supporting texts")
+    p.add("--max-pmids", type=int, default=80, help="maximum number of pmids in a pubmed reference url")
+    p.add("--seed", type=int, default=0, help="random seed")
+    p.add("--latency", type=float, default=0, help="seconds the fake wikibase waits before each api reply")
+    p.add("--concurrency", type=int, default=1, help="neo4j_to_wd.py --concurrency")
+    p.add("--chunksize", type=int, help="neo4j_to_wd.py --chunksize")
+    p.add("--entity-cache", action='store_true', help="sync with an entity cache")
+    p.add("--id-store", action='store_true', help="sync with an id store")
+    p.add("--resync", action='store_true', help="sync the same graph a second time")
+    p.add("--chunk-size", type=int, default=50, help="wd_to_neo4j.py --chunk-size")
+    p.add("--fetch-workers", type=int, default=4, help="wd_to_neo4j.py --fetch-workers")
+    p.add("--processes", type=int, default=1, help="wd_to_neo4j.py --processes")
+    p.add("--json-out", help="also write the results to this json file")
+    options, _ = p.parse_known_args()
+    main(**options.__dict__)
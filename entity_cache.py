@@ -0,0 +1,106 @@
+import json
+import sqlite3
+import threading
+import zlib
+from collections import defaultdict
+
+
+class EntityCache:
+    """
+    The claims and last revision id of entities, as they were after our last read or write of them, in a sqlite file.
+    Entries are replaced with the entity returned by each write and dropped when a write fails, so the next write
+    of the entity reads it again.
+    """
+
+    def __init__(self, path):
+        # writes come from the write pipeline's threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS entity (id TEXT PRIMARY KEY, lastrevid INTEGER, "
+                              "claims BLOB)")
+
+    def get(self, eid):
+        # returns {'claims': ..., 'lastrevid': ...} or None
+        with self.lock:
+            row = self.conn.execute("SELECT lastrevid, claims FROM entity WHERE id = ?", (eid,)).fetchone()
+        if row is None:
+            return None
+        return {'lastrevid': row[0], 'claims': json.loads(zlib.decompress(row[1]).decode())}
+
+    def put(self, eid, entity):
+        # entity: the entity json, as returned by wbgetentities or wbeditentity
+        if entity.get('lastrevid') is None:
+            self.invalidate(eid)
+            return
+        claims = zlib.compress(json.dumps(entity.get('claims', dict())).encode())
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO entity VALUES (?, ?, ?)", (eid, entity['lastrevid'], claims))
+
+    def invalidate(self, eid):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM entity WHERE id = ?", (eid,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def snak_key(snak):
+    # the value of a snak, without the hashes and ids that wikibase adds
+    value = snak.get('datavalue', dict()).get('value')
+    if isinstance(value, dict):
+        value = {k: v for k, v in value.items() if k != 'id'}
+    return snak['property'], snak['snaktype'], json.dumps(value, sort_keys=True)
+
+
+def snaks_key(snaks, order=None):
+    # snaks: {prop: [snak]}. order: the snaks-order, which can have repeats before wikibase normalizes it
+    order = dict.fromkeys(order if order else sorted(snaks))
+    return tuple(snak_key(snak) for prop in order for snak in snaks.get(prop, []))
+
+
+def claim_value_key(claim):
+    # what makes two statements equal for the item engine: the main value and the qualifiers
+    return snak_key(claim['mainsnak']), snaks_key(claim.get('qualifiers', dict()), claim.get('qualifiers-order'))
+
+
+def claim_refs_key(claim):
+    refs = tuple(snaks_key(ref['snaks'], ref.get('snaks-order')) for ref in claim.get('references', []))
+    return refs, claim.get('rank', 'normal')
+
+
+def diff_claims(claims, statements):
+    """
+    Returns the claims to send to wbeditentity ({prop: [claim]}) to give an entity with `claims` the statements in
+    `statements`, or an empty dict if it already has them.
+    Same as writing `statements` with an item engine: all values of the statements' properties are replaced,
+    existing claims with a value that is kept get the new references, and WDBaseDataType.delete_statement(prop)
+    removes all values of prop.
+    """
+    desired = defaultdict(list)
+    deleted = set()
+    for s in statements:
+        if s.get_value() == '':
+            deleted.add(s.get_prop_nr())
+        else:
+            desired[s.get_prop_nr()].append(s.get_json_representation())
+
+    edits = defaultdict(list)
+    for prop in sorted(deleted):
+        edits[prop].extend({'id': claim['id'], 'remove': ''} for claim in claims.get(prop, []))
+    for prop, new_claims in desired.items():
+        new_by_value = {claim_value_key(claim): claim for claim in new_claims}
+        kept = set()
+        for claim in claims.get(prop, []):
+            key = claim_value_key(claim)
+            new_claim = new_by_value.get(key)
+            if new_claim is None:
+                edits[prop].append({'id': claim['id'], 'remove': ''})
+                continue
+            kept.add(key)
+            if claim_refs_key(claim) != claim_refs_key(new_claim):
+                claim = dict(claim, references=new_claim.get('references', []), rank=new_claim.get('rank', 'normal'))
+                edits[prop].append(claim)
+        edits[prop].extend(claim for key, claim in new_by_value.items() if key not in kept)
+    return {prop: prop_edits for prop, prop_edits in edits.items() if prop_edits}
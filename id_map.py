@@ -0,0 +1,326 @@
+import threading
+import zlib
+from array import array
+from collections.abc import Mapping, MutableMapping
+
+import numpy as np
+
+kinds = "QP"
+
+
+def split_value(value):
+    # "UniProt:Q96IV0" -> ("UniProt:", "Q96IV0"). the prefix ends with the last ":", "/" or "#"
+    n = max(value.rfind(":"), value.rfind("/"), value.rfind("#")) + 1
+    return value[:n], value[n:]
+
+
+def encode_id(eid):
+    # "Q42" -> 84, "P42" -> 85. None for any other id
+    kind = kinds.find(eid[:1])
+    try:
+        number = int(eid[1:])
+    except ValueError:
+        return None
+    if kind < 0 or number < 0 or str(number) != eid[1:]:
+        return None
+    return number * 2 + kind
+
+
+def decode_id(code):
+    return kinds[code % 2] + str(code // 2)
+
+
+def spread(x, bits):
+    # fibonacci hashing: the top bits of x times 2^64 / golden ratio, as a slot of a table of 2^bits
+    return ((x * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> (64 - bits)
+
+
+def build_slots(keys, bits, rows=None):
+    # an open addressing table with linear probing of 2^bits slots, each -1 or a row. keys: uint64 array by row.
+    # rows: the rows to put in, all by default.
+    # rows go in by rounds: those whose slot is free take it, lowest row first, and the others move on to the next
+    mask = (1 << bits) - 1
+    slots = np.full(1 << bits, -1, dtype=np.int32)
+    rows = np.arange(len(keys), dtype=np.int64) if rows is None else rows
+    pos = ((keys[rows] * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(64 - bits)).astype(np.int64)
+    while len(rows):
+        free = np.flatnonzero(slots[pos] < 0)
+        taken, first = np.unique(pos[free], return_index=True)
+        slots[taken] = rows[free[first]]
+        left = np.ones(len(rows), dtype=bool)
+        left[free[first]] = False
+        rows, pos = rows[left], (pos[left] + 1) & mask
+    return slots
+
+
+class Table:
+    """
+    The bulk of an IdMap, built once and only read after that. Row n maps prefixes[prefix[n]] +
+    blob[offsets[n]:offsets[n + 1]] to the entity decode_id(codes[n]). Rows are found by value through
+    value_slots, hashed on the crc32 of the value, and by entity through id_slots, hashed on the code, which only
+    has the last row added for each entity. Both are at most half full.
+    """
+
+    def __init__(self, items, prefixes, prefix_ids, extra):
+        # items: (value, entity id) pairs with distinct values. prefixes and prefix_ids are shared and grow.
+        # entities that aren't a Q or P id go to extra
+        codes, prefix, hashes, offsets = array('q'), array('I'), array('Q'), array('q', [0])
+        blob = bytearray()
+        for value, eid in items:
+            code = encode_id(eid)
+            if code is None:
+                extra[value] = eid
+                continue
+            head, tail = split_value(value)
+            if head not in prefix_ids:
+                prefix_ids[head] = len(prefixes)
+                prefixes.append(head)
+            codes.append(code)
+            prefix.append(prefix_ids[head])
+            hashes.append(zlib.crc32(value.encode()))
+            blob += tail.encode()
+            offsets.append(len(blob))
+        self.codes = np.frombuffer(codes, dtype=np.int64) if codes else np.zeros(0, dtype=np.int64)
+        self.prefix = np.frombuffer(prefix, dtype=np.uint32) if prefix else np.zeros(0, dtype=np.uint32)
+        self.offsets = np.frombuffer(offsets, dtype=np.int64)
+        self.blob = bytes(blob)
+        self.bits = max(4, (2 * len(self.codes)).bit_length())
+        self.value_slots = build_slots(np.frombuffer(hashes, dtype=np.uint64) if hashes else
+                                       np.zeros(0, dtype=np.uint64), self.bits)
+        # the last row of each entity: the first of the reversed codes
+        _, last = np.unique(self.codes[::-1], return_index=True)
+        last = len(self.codes) - 1 - last
+        self.id_slots = build_slots(self.codes.astype(np.uint64), self.bits, np.sort(last))
+        self.make_views()
+
+    def make_views(self):
+        # indexing a memoryview gives python ints, much faster than numpy scalars
+        self.views = [memoryview(x) for x in (self.codes, self.prefix, self.offsets, self.value_slots,
+                                               self.id_slots)]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['views']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.make_views()
+
+    def __len__(self):
+        return len(self.codes)
+
+    def value(self, row, prefixes):
+        _, prefix, offsets, _, _ = self.views
+        return prefixes[prefix[row]] + self.blob[offsets[row]:offsets[row + 1]].decode()
+
+    def find(self, value, prefixes):
+        # the row of value, or None
+        slots = self.views[3]
+        mask = len(slots) - 1
+        slot = spread(zlib.crc32(value.encode()), self.bits)
+        while slots[slot] >= 0:
+            if self.value(slots[slot], prefixes) == value:
+                return slots[slot]
+            slot = (slot + 1) & mask
+        return None
+
+    def last_row(self, code):
+        # the last row added for the entity, or None
+        codes, slots = self.views[0], self.views[4]
+        mask = len(slots) - 1
+        slot = spread(code, self.bits)
+        while slots[slot] >= 0:
+            if codes[slots[slot]] == code:
+                return slots[slot]
+            slot = (slot + 1) & mask
+        return None
+
+    def rows_of(self, code):
+        # all the rows of the entity, the last one added first
+        return np.flatnonzero(self.codes == code)[::-1].tolist()
+
+
+class IdMap(MutableMapping):
+    """
+    A {value: entity id} dict (e.g. {curie: QID} from id_mapper) in a fraction of the memory: entity ids are stored as
+    integers, the prefixes of values (e.g. "UniProt:", "http://purl.obolibrary.org/obo/") are interned and the rest
+    of each value is packed into one bytes object, indexed by numpy arrays (see Table). inverse() gives the
+    {entity id: value} view.
+    Values set after it's built go to a dict on top of the table, which is rebuilt once that dict gets big.
+    Safe to use from the write pipeline's threads.
+    """
+    # the table is rebuilt when more than this many values (or a quarter of the table) were set since
+    min_compact = 1 << 16
+
+    def __init__(self, items=()):
+        # items: a mapping or (value, entity id) pairs
+        items = items.items() if isinstance(items, Mapping) else items
+        self.lock = threading.Lock()
+        self.prefixes = []
+        self.prefix_ids = dict()
+        # {value: entity id} set after the table was built, or None if deleted. entities that aren't Q or P ids
+        self.added = dict()
+        self.added_inverse = dict()
+        self.extra = dict()
+        self.table = Table(items, self.prefixes, self.prefix_ids, self.extra)
+        self.size = len(self.table) + len(self.extra)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    # reads don't take the lock. writes never change the dicts or the table a reader may be holding, except to set
+    # new values in added and added_inverse, and replace them in the order table, extra, added_inverse, added. so
+    # readers get them in the reverse order. a value set again replaces added with a copy that has it last
+
+    def lookup(self, value):
+        # the entity id of value or None
+        added, extra, table = self.added, self.extra, self.table
+        if value in added:
+            return added[value]
+        if value in extra:
+            return extra[value]
+        row = table.find(value, self.prefixes)
+        return None if row is None else decode_id(table.views[0][row])
+
+    def __getitem__(self, value):
+        eid = self.lookup(value)
+        if eid is None:
+            raise KeyError(value)
+        return eid
+
+    def __contains__(self, value):
+        return self.lookup(value) is not None
+
+    def __setitem__(self, value, eid):
+        with self.lock:
+            if self.lookup(value) is None:
+                self.size += 1
+            if value in self.added:
+                # added is in the order values were last set, which the inverse goes by. readers may hold it
+                added = dict(self.added)
+                del added[value]
+                added[value] = eid
+                self.added = added
+            else:
+                self.added[value] = eid
+            self.added_inverse[eid] = value
+            if len(self.added) > max(self.min_compact, len(self.table) // 4):
+                self.compact()
+
+    def __delitem__(self, value):
+        with self.lock:
+            if self.lookup(value) is None:
+                raise KeyError(value)
+            self.size -= 1
+            self.added[value] = None
+
+    def compact(self):
+        # rebuild the table with the values added since. the lock must be held
+        extra = dict()
+        self.table = Table(list(self.iter_items(self.table, self.added, self.extra)), self.prefixes, self.prefix_ids,
+                           extra)
+        self.extra = extra
+        self.added_inverse = dict()
+        self.added = dict()
+
+    def snapshot(self):
+        # what to iterate over, so the map can be changed while iterating
+        with self.lock:
+            return self.table, dict(self.added), dict(self.extra)
+
+    def iter_items(self, table, added, extra):
+        for row in range(len(table)):
+            value = table.value(row, self.prefixes)
+            if value not in added:
+                yield value, decode_id(table.views[0][row])
+        for value, eid in extra.items():
+            if value not in added:
+                yield value, eid
+        for value, eid in added.items():
+            if eid is not None:
+                yield value, eid
+
+    def __iter__(self):
+        for value, _ in self.iter_items(*self.snapshot()):
+            yield value
+
+    def __len__(self):
+        return self.size
+
+    def key_of(self, eid):
+        # the value mapping to eid (the last one added if there are several), or None
+        added, added_inverse, extra, table = self.added, self.added_inverse, self.extra, self.table
+        value = added_inverse.get(eid)
+        if value is not None:
+            if added.get(value) == eid:
+                return value
+            # the entity's last value was changed since it was set, so look for the last one that wasn't
+            found = None
+            for value, x in list(added.items()):
+                if x == eid:
+                    found = value
+            if found is not None:
+                return found
+        code = encode_id(eid)
+        row = None if code is None else table.last_row(code)
+        if row is not None:
+            value = table.value(row, self.prefixes)
+            if value not in added:
+                return value
+            # it was changed since the table was built, so look for an earlier value of the entity
+            for row in table.rows_of(code):
+                value = table.value(row, self.prefixes)
+                if value not in added:
+                    return value
+        found = None
+        for value, x in extra.items():
+            if x == eid and value not in added:
+                found = value
+        return found
+
+    def inverse(self):
+        return InverseIdMap(self)
+
+
+class InverseIdMap(Mapping):
+    """
+    The {entity id: value} view of an IdMap. If several values map to the same entity, it gives the last one added.
+    """
+
+    def __init__(self, id_map):
+        self.id_map = id_map
+
+    def __getitem__(self, eid):
+        value = self.id_map.key_of(eid)
+        if value is None:
+            raise KeyError(eid)
+        return value
+
+    def __contains__(self, eid):
+        return self.id_map.key_of(eid) is not None
+
+    def __iter__(self):
+        # each entity once, those of the table in order of their ids
+        table, added, extra = self.id_map.snapshot()
+        for code in np.unique(table.codes).tolist():
+            eid = decode_id(code)
+            # the values of an entity may all have been changed or deleted since the table was built
+            if not added or eid in self:
+                yield eid
+        seen = set()
+        for eid in list(extra.values()) + [x for x in added.values() if x is not None]:
+            code = encode_id(eid)
+            in_table = code is not None and table.last_row(code) is not None
+            if eid not in seen and not in_table and eid in self:
+                seen.add(eid)
+                yield eid
+
+    def __len__(self):
+        return sum(1 for _ in self)
@@ -0,0 +1,100 @@
+import sqlite3
+import threading
+
+from wikidataintegrator import wdi_core, wdi_helpers
+
+from id_map import IdMap
+
+
+class IdStore:
+    """
+    A local, persistent copy of id_mapper results ({property: {value: entity id}}) and of entity labels and
+    descriptions, kept in a sqlite file.
+    A mapping is loaded in full the first time it's used. After that, only the entities modified since the previous
+    refresh are queried. IDs minted by the bots are recorded as they are created.
+    """
+
+    def __init__(self, path, sparql_endpoint_url, entity="http://wikibase.svc"):
+        # entity: the subject of the sparql endpoint's schema:dateModified, i.e. when it was last updated
+        self.sparql_endpoint_url = sparql_endpoint_url
+        self.entity = entity
+        self.refreshed = set()
+        # records come from the write pipeline's threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS mapping (prop TEXT, value TEXT, id TEXT, "
+                              "PRIMARY KEY (prop, value))")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS mapping_id ON mapping (prop, id)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS synced (prop TEXT PRIMARY KEY, last_modified TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS entity_text (id TEXT PRIMARY KEY, label TEXT, "
+                              "description TEXT)")
+
+    def id_mapper(self, prop):
+        # same as wdi_helpers.id_mapper(prop) as an IdMap, except that no results gives an empty one
+        self.refresh(prop)
+        with self.lock:
+            return IdMap(self.conn.execute("SELECT value, id FROM mapping WHERE prop = ?", (prop,)))
+
+    def refresh(self, prop):
+        # once per run, bring the mapping of prop up to date with the sparql endpoint
+        if prop in self.refreshed:
+            return
+        # anything modified after this will be picked up by the next refresh
+        last_modified = wdi_helpers.get_last_modified_header(entity=self.entity, endpoint=self.sparql_endpoint_url)
+        last_modified = last_modified.strftime('%Y-%m-%dT%H:%M:%SZ')
+        with self.lock:
+            row = self.conn.execute("SELECT last_modified FROM synced WHERE prop = ?", (prop,)).fetchone()
+        if row is None:
+            query = "SELECT ?item ?id WHERE {{ ?item p:{0} ?s . ?s ps:{0} ?id . }}".format(prop)
+        else:
+            # modified entities without a value for prop are returned too, so removed values get dropped
+            query = """SELECT ?item ?id WHERE {{
+              ?item schema:dateModified ?mod .
+              FILTER(?mod >= "{1}"^^xsd:dateTime)
+              OPTIONAL {{ ?item p:{0} ?s . ?s ps:{0} ?id . }}
+            }}""".format(prop, row[0])
+        results = wdi_core.WDItemEngine.execute_sparql_query(query, endpoint=self.sparql_endpoint_url)
+        rows = [(x['item']['value'].split("/")[-1], x['id']['value'] if 'id' in x else None)
+                for x in results['results']['bindings']]
+        modified = sorted({eid for eid, _ in rows})
+        if row is None:
+            print("{}: loaded {} mappings".format(prop, len(rows)))
+        else:
+            print("{}: {} entities modified since {}".format(prop, len(modified), row[0]))
+
+        with self.lock, self.conn:
+            if row is not None:
+                self.conn.executemany("DELETE FROM mapping WHERE prop = ? AND id = ?", [(prop, x) for x in modified])
+                self.conn.executemany("DELETE FROM entity_text WHERE id = ?", [(x,) for x in modified])
+            self.conn.executemany("INSERT OR REPLACE INTO mapping VALUES (?, ?, ?)",
+                                  [(prop, value, eid) for eid, value in rows if value is not None])
+            self.conn.execute("INSERT OR REPLACE INTO synced VALUES (?, ?)", (prop, last_modified))
+        self.refreshed.add(prop)
+
+    def record(self, prop, value, eid):
+        # an entity that was just created with this value for prop
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO mapping VALUES (?, ?, ?)", (prop, value, eid))
+
+    def get_texts(self, ids):
+        # returns {id: (label, description)} for the ids that are cached
+        ids = list(ids)
+        texts = dict()
+        with self.lock:
+            for n in range(0, len(ids), 500):
+                chunk = ids[n:n + 500]
+                query = "SELECT id, label, description FROM entity_text WHERE id IN ({})".format(
+                    ",".join("?" * len(chunk)))
+                texts.update((eid, (label, descr)) for eid, label, descr in self.conn.execute(query, chunk))
+        return texts
+
+    def set_texts(self, texts):
+        # texts: {id: (label, description)}
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO entity_text VALUES (?, ?, ?)",
+                                  [(eid, label, descr) for eid, (label, descr) in texts.items()])
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,168 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlparse
+
+# upper bounds, in seconds, of the latency histogram buckets
+latency_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics:
+    """
+    Counters and histograms of a bot run, e.g. metrics.inc("items_total", result="created") or
+    `with metrics.timer("stage_seconds", stage="nodes"): ...`. Safe to use from the write pipeline's threads.
+    Snapshots are written to `path` every `interval` seconds once started, and by `write` and `close`: as a line of
+    json appended to the file, or in the prometheus text format (replacing the file, for the node exporter's
+    textfile collector). Without a path, nothing is written.
+    """
+
+    def __init__(self, bot, path=None, fmt="jsonl", interval=60):
+        if fmt not in {"jsonl", "prometheus"}:
+            raise ValueError("unknown metrics format: {}".format(fmt))
+        self.bot = bot
+        self.path = path
+        self.fmt = fmt
+        self.interval = interval
+        self.lock = threading.Lock()
+        # {(name, labels): value}, where labels is a sorted tuple of (label, value)
+        self.counters = defaultdict(float)
+        # {(name, labels): [count per bucket (the last one is +Inf), sum]}
+        self.histograms = dict()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[self.key(name, labels)] += value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * (len(latency_buckets) + 1), 0]
+            histogram = self.histograms[key]
+            histogram[0][bisect_left(latency_buckets, value)] += 1
+            histogram[1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # observes the time taken by the block, even if it raises
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t, **labels)
+
+    def instrument(self, session):
+        # record the latency and size of every api call made with a requests session
+        session.hooks['response'].append(self.response_hook)
+
+    def response_hook(self, response, *args, **kwargs):
+        request = response.request
+        body = request.body or b""
+        body = body.encode() if isinstance(body, str) else body
+        if urlparse(request.url).path.endswith("sparql"):
+            action = "sparql"
+        else:
+            params = parse_qs(urlparse(request.url).query)
+            params.update(parse_qs(body.decode(errors="replace")) if body else dict())
+            action = params.get('action', ["unknown"])[0]
+        self.observe("api_request_seconds", response.elapsed.total_seconds(), action=action)
+        self.inc("api_requests_total", action=action, status=response.status_code)
+        self.inc("api_sent_bytes_total", len(body), action=action)
+        self.inc("api_received_bytes_total", len(response.content), action=action)
+
+    def snapshot(self):
+        # {'counters': [{'name', 'labels', 'value'}], 'histograms': [{'name', 'labels', 'buckets', 'sum', 'count'}]}
+        # in the order the metrics were first seen. histogram buckets are cumulative, keyed by their upper bound
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = [(k, (list(v[0]), v[1])) for k, v in self.histograms.items()]
+        snapshot = {'counters': [], 'histograms': []}
+        for (name, labels), value in counters:
+            snapshot['counters'].append({'name': name, 'labels': dict(labels), 'value': value})
+        for (name, labels), (counts, total) in histograms:
+            cumulative = [sum(counts[:n + 1]) for n in range(len(counts))]
+            buckets = dict(zip([str(x) for x in latency_buckets] + ["+Inf"], cumulative))
+            snapshot['histograms'].append({'name': name, 'labels': dict(labels), 'buckets': buckets,
+                                           'sum': total, 'count': cumulative[-1]})
+        return snapshot
+
+    def merge(self, snapshot):
+        # add the counters and histograms of a snapshot, e.g. from a worker process
+        with self.lock:
+            for x in snapshot['counters']:
+                self.counters[self.key(x['name'], x['labels'])] += x['value']
+            for x in snapshot['histograms']:
+                key = self.key(x['name'], x['labels'])
+                if key not in self.histograms:
+                    self.histograms[key] = [[0] * (len(latency_buckets) + 1), 0]
+                histogram = self.histograms[key]
+                cumulative = list(x['buckets'].values())
+                for n, count in enumerate(cumulative):
+                    histogram[0][n] += count - (cumulative[n - 1] if n else 0)
+                histogram[1] += x['sum']
+
+    def prometheus(self, snapshot):
+        lines = []
+
+        def fmt_labels(labels):
+            labels = dict(labels, bot=self.bot)
+            return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                                  for k, v in sorted(labels.items())) + "}"
+
+        # the lines of a metric have to be together, after its type
+        for kind, metric_type in (('counters', "counter"), ('histograms', "histogram")):
+            last_name = None
+            for x in sorted(snapshot[kind], key=lambda x: x['name']):
+                name = "krusty_" + x['name']
+                if name != last_name:
+                    lines.append("# TYPE {} {}".format(name, metric_type))
+                    last_name = name
+                if kind == 'counters':
+                    lines.append("{}{} {}".format(name, fmt_labels(x['labels']), x['value']))
+                    continue
+                for le, count in x['buckets'].items():
+                    lines.append("{}_bucket{} {}".format(name, fmt_labels(dict(x['labels'], le=le)), count))
+                lines.append("{}_sum{} {}".format(name, fmt_labels(x['labels']), x['sum']))
+                lines.append("{}_count{} {}".format(name, fmt_labels(x['labels']), x['count']))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        if not self.path:
+            return
+        snapshot = self.snapshot()
+        if self.fmt == "jsonl":
+            with open(self.path, "a") as f:
+                f.write(json.dumps(dict(time=time.time(), bot=self.bot, **snapshot)) + "\n")
+        else:
+            # written to a temp file and moved in place, so a scraper never reads half a file
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(self.prometheus(snapshot))
+            os.replace(tmp_path, self.path)
+
+    def start(self):
+        # write a snapshot every interval seconds in a background thread, until close
+        if not self.path or self.thread:
+            return
+        self.thread = threading.Thread(target=self.write_periodically, daemon=True)
+        self.thread.start()
+
+    def write_periodically(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def close(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.write()
@@ -0,0 +1,339 @@
+import heapq
+import json
+import tempfile
+from collections import defaultdict
+from itertools import chain
+
+import pandas as pd
+
+from metrics import Metrics
+from sync_state import Snapshot, row_hash
+
+# csv column: neo4j property, as neo4j-admin import reads wd_to_neo4j's csvs. :IGNORE columns aren't imported
+node_properties = {'id:ID': 'id', 'preflabel': 'preflabel', 'name': 'name', 'description': 'description'}
+edge_properties = ['reference_uri', 'reference_supporting_text', 'reference_date', 'property_label', 'property_uri']
+# the csv columns neo4j_to_wd reads
+node_columns = ['id:ID', ':LABEL', 'preflabel', 'synonyms:IGNORE', 'name', 'description']
+edge_columns = [':START_ID', ':TYPE', ':END_ID', 'reference_uri', 'reference_supporting_text', 'reference_date',
+                'property_label', 'property_description:IGNORE', 'property_uri']
+# what pandas.read_csv reads as a missing value
+na_values = {"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A",
+             "NA", "NULL", "NaN", "None", "n/a", "nan", "null"}
+
+
+def connect(uri, user, password):
+    # the neo4j driver is only needed for the neo4j backends
+    from neo4j import GraphDatabase
+    return GraphDatabase.driver(uri, auth=(user, password))
+
+
+def quote(name):
+    # labels and relationship types can't be query parameters
+    return "`" + name.replace("`", "``") + "`"
+
+
+def csv_value(value):
+    # what neo4j-admin import gets from the csvs for this value
+    return "NA" if value is None or value == '' else value
+
+
+def frame_value(value):
+    # what neo4j_to_wd gets from a csv cell holding this value. the inverse of csv_value
+    if isinstance(value, list):
+        value = "|".join(str(x) for x in value)
+    return "" if value is None or str(value) in na_values else str(value)
+
+
+class Neo4jSink:
+    """
+    Writes wd_to_neo4j's node and edge rows straight into a running neo4j, giving the same graph as a neo4j-admin
+    import of the csvs, but only writing what changed since the last run.
+    The state of the last run is kept in a Snapshot at state_path, with
+    nodes: {id: [hash of the node row, label]}
+    edges: {subject id: [hash of the subject's edge rows, [end ids that weren't nodes]]}
+    Changed nodes are upserted as they come in. Nodes that are gone are deleted with their relationships. Once all
+    nodes are written, subjects whose edges changed (or that point to a node that was just added) get their outgoing
+    relationships replaced. Without a state, everything is written and nothing is deleted.
+    """
+
+    def __init__(self, driver, state_path=None, batch_size=1000, database=None, metrics=None):
+        self.driver = driver
+        self.state_path = state_path
+        self.batch_size = batch_size
+        self.metrics = metrics if metrics else Metrics("wd_to_neo4j")
+        self.session = driver.session(database=database) if database else driver.session()
+        self.old = Snapshot.load(state_path) if state_path else Snapshot()
+        self.new = Snapshot()
+        # node writes waiting for a batch: {label: [properties]} and {(old label, label): [id]}
+        self.pending_nodes = defaultdict(list)
+        self.pending_relabels = defaultdict(list)
+        self.n_pending = 0
+        self.indexed_labels = set()
+        # edge rows of the subjects that may need rewriting. they're written once all nodes are
+        self.spool = tempfile.TemporaryFile("w+t", encoding="utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # the state is only saved if everything was written
+        try:
+            if exc_type is None:
+                self.finish()
+        finally:
+            self.session.close()
+            self.spool.close()
+
+    def run(self, query, kind, **params):
+        with self.metrics.timer("cypher_seconds", query=kind):
+            return list(self.session.run(query, **params))
+
+    def run_batches(self, query, kind, rows):
+        for n in range(0, len(rows), self.batch_size):
+            self.run(query, kind, rows=rows[n:n + self.batch_size])
+
+    def write(self, node_id, node_row, edge_rows):
+        # the rows of one item. node_row is None if the item isn't a node
+        if node_row:
+            label = node_row[':LABEL']
+            props = {prop: csv_value(node_row.get(column)) for column, prop in node_properties.items()}
+            h = row_hash([label] + [props[x] for x in node_properties.values()])
+            self.new.nodes[node_id] = [h, label]
+            old = self.old.nodes.get(node_id)
+            if old is None or old[0] != h:
+                if old is not None and old[1] != label:
+                    self.pending_relabels[(old[1], label)].append(node_id)
+                self.pending_nodes[label].append(props)
+                self.n_pending += 1
+                if self.n_pending >= self.batch_size:
+                    self.flush_nodes()
+
+        rows = [[row[':TYPE'], row[':END_ID'], {x: csv_value(row.get(x)) for x in edge_properties}]
+                for row in edge_rows]
+        h = row_hash(sorted(json.dumps(row, sort_keys=True) for row in rows))
+        old = self.old.edges.get(node_id)
+        if old is not None and old[0] == h and node_id in self.old.nodes and not old[1]:
+            # unchanged, and every end was a node already
+            self.new.edges[node_id] = old
+            return
+        changed = old is None or old[0] != h or node_id not in self.old.nodes
+        self.spool.write(json.dumps([node_id, changed, h, old[1] if old else [], rows]) + "\n")
+
+    def ensure_index(self, label):
+        if label in self.indexed_labels:
+            return
+        try:
+            self.run("CREATE INDEX IF NOT EXISTS FOR (n:{}) ON (n.id)".format(quote(label)), "index")
+        except Exception:
+            # neo4j before 4.1
+            self.run("CREATE INDEX ON :{}(id)".format(quote(label)), "index")
+        self.indexed_labels.add(label)
+
+    def flush_nodes(self):
+        for (old_label, label), ids in self.pending_relabels.items():
+            self.run_batches("UNWIND $rows AS id MATCH (n:{} {{id: id}}) REMOVE n:{} SET n:{}".format(
+                quote(old_label), quote(old_label), quote(label)), "relabel_nodes", ids)
+        for label, rows in self.pending_nodes.items():
+            self.ensure_index(label)
+            self.run_batches("UNWIND $rows AS row MERGE (n:{} {{id: row.id}}) SET n = row".format(quote(label)),
+                             "merge_nodes", rows)
+            self.metrics.inc("neo4j_nodes_written_total", len(rows))
+        self.pending_relabels.clear()
+        self.pending_nodes.clear()
+        self.n_pending = 0
+
+    def delete_nodes(self, ids):
+        # returns {subject id: [ids of deleted nodes it had relationships to]}
+        by_label = defaultdict(list)
+        for node_id in ids:
+            by_label[self.old.nodes[node_id][1]].append(node_id)
+        orphaned = defaultdict(list)
+        for label, label_ids in by_label.items():
+            for n in range(0, len(label_ids), self.batch_size):
+                batch = label_ids[n:n + self.batch_size]
+                for record in self.run("UNWIND $rows AS id MATCH (a)-->(n:{} {{id: id}}) "
+                                       "RETURN DISTINCT a.id AS start, n.id AS end".format(quote(label)),
+                                       "find_orphaned", rows=batch):
+                    orphaned[record['start']].append(record['end'])
+                self.run("UNWIND $rows AS id MATCH (n:{} {{id: id}}) DETACH DELETE n".format(quote(label)),
+                         "delete_nodes", rows=batch)
+            self.metrics.inc("neo4j_nodes_deleted_total", len(label_ids))
+        return orphaned
+
+    def read_spool(self):
+        self.spool.seek(0)
+        for line in self.spool:
+            yield json.loads(line)
+
+    def finish(self):
+        self.flush_nodes()
+        added = set(self.new.nodes) - set(self.old.nodes)
+        removed = set(self.old.nodes) - set(self.new.nodes)
+        # subjects keep their relationships to these nodes until they're rewritten, so those ends now dangle
+        orphaned = self.delete_nodes(sorted(removed))
+
+        # subjects to rewrite, grouped by label for deleting their relationships
+        rewrite = defaultdict(list)
+        for node_id, changed, h, dangling, rows in self.read_spool():
+            if node_id not in self.new.nodes:
+                # not a node, so there are no relationships to write
+                continue
+            if changed or set(dangling) & added:
+                rewrite[self.new.nodes[node_id][1]].append(node_id)
+            else:
+                self.new.edges[node_id] = [h, dangling]
+        for label, ids in rewrite.items():
+            self.run_batches("UNWIND $rows AS id MATCH (a:{} {{id: id}})-[r]->() DELETE r".format(quote(label)),
+                             "delete_relationships", ids)
+            self.metrics.inc("neo4j_subjects_rewritten_total", len(ids))
+
+        rewrite = {node_id for ids in rewrite.values() for node_id in ids}
+        pending = defaultdict(list)
+        for node_id, changed, h, dangling, rows in self.read_spool():
+            if node_id not in rewrite:
+                continue
+            dangling = set()
+            for rel_type, end, props in rows:
+                if end not in self.new.nodes:
+                    dangling.add(end)
+                    continue
+                key = (self.new.nodes[node_id][1], rel_type, self.new.nodes[end][1])
+                pending[key].append({'start': node_id, 'end': end, 'props': props})
+                if len(pending[key]) >= self.batch_size:
+                    self.create_relationships(key, pending.pop(key))
+            self.new.edges[node_id] = [h, sorted(dangling)]
+        for key, rows in pending.items():
+            self.create_relationships(key, rows)
+
+        for node_id, ends in orphaned.items():
+            if node_id in self.new.edges and node_id not in rewrite:
+                self.new.edges[node_id] = [self.new.edges[node_id][0], sorted(set(self.new.edges[node_id][1]) |
+                                                                             set(ends))]
+        if self.state_path:
+            self.new.save(self.state_path)
+
+    def create_relationships(self, key, rows):
+        start_label, rel_type, end_label = key
+        self.run_batches("UNWIND $rows AS row MATCH (a:{} {{id: row.start}}), (b:{} {{id: row.end}}) "
+                         "CREATE (a)-[r:{}]->(b) SET r = row.props".format(quote(start_label), quote(end_label),
+                                                                         quote(rel_type)),
+                         "create_relationships", rows)
+        self.metrics.inc("neo4j_relationships_written_total", len(rows))
+
+
+class Neo4jSource:
+    """
+    Reads the nodes and relationships of a running neo4j as dataframes with the columns of the csvs neo4j_to_wd reads,
+    so it can sync without an export. The nodes of each label are read in pages of page_size, keyset paginated on
+    their id, and the labels are merged so that the edges come out sorted by :START_ID. Nodes are expected to have a
+    single label and an id, as in an import of the csvs.
+    With modified_property and since, only the nodes whose modified_property is >= since are read, and all the edges
+    of the subjects that were modified or have a modified outgoing relationship. The labels are always read from all
+    the nodes, as a duplicate label can be on a node that wasn't modified.
+    """
+    node_query = ("MATCH (n:{}) WHERE n.id > $after{} "
+                  "RETURN n.id AS id, n.preflabel AS preflabel, n.synonyms AS synonyms, n.name AS name, "
+                  "n.description AS description ORDER BY n.id LIMIT $limit")
+    label_query = ("MATCH (n:{}) WHERE n.id > $after{} "
+                   "RETURN n.id AS id, n.preflabel AS preflabel, n.name AS name ORDER BY n.id LIMIT $limit")
+    # subjects without relationships give a row with nulls, so the page still ends with the last subject
+    edge_query = ("MATCH (n:{}) WHERE n.id > $after{} WITH n ORDER BY n.id LIMIT $limit "
+                  "OPTIONAL MATCH (n)-[r]->(m) "
+                  "RETURN n.id AS id, type(r) AS type, m.id AS end, properties(r) AS props ORDER BY id")
+
+    def __init__(self, driver, database=None, page_size=10000, modified_property=None, since=None, metrics=None):
+        if since is not None and not modified_property:
+            raise ValueError("since needs a modified_property")
+        self.driver = driver
+        self.database = database
+        self.page_size = page_size
+        self.modified_property = modified_property
+        self.since = since
+        self.metrics = metrics if metrics else Metrics("neo4j_to_wd")
+        self.session = driver.session(database=database) if database else driver.session()
+
+    def close(self):
+        self.session.close()
+
+    def run(self, query, kind, **params):
+        with self.metrics.timer("cypher_seconds", query=kind):
+            return list(self.session.run(query, **params))
+
+    def run_id(self):
+        # what a journal of a run reading this source is for
+        return ["neo4j", self.database, self.modified_property, self.since]
+
+    def server_time(self):
+        # epoch milliseconds, as timestamp() sets them. the watermark of the next run
+        return self.run("RETURN timestamp() AS t", "server_time")[0]['t']
+
+    def labels(self):
+        return sorted(x['label'] for x in self.run("CALL db.labels() YIELD label RETURN label", "labels"))
+
+    def pages(self, query, kind, label, subjects=False, modified=True):
+        # the records of query for the next page of nodes of label, until the last page.
+        # subjects: also keep the nodes with a modified outgoing relationship
+        # modified: only the modified nodes when there's a watermark, else all of them
+        where = ""
+        params = dict()
+        if self.since is not None and modified:
+            where = " AND n[$prop] >= $since"
+            if subjects:
+                where = " AND (n[$prop] >= $since OR any(y IN [(n)-[x]->() | x] WHERE y[$prop] >= $since))"
+            params = {'prop': self.modified_property, 'since': self.since}
+        query = query.format(quote(label), where)
+        after = ""
+        while True:
+            records = self.run(query, kind, after=after, limit=self.page_size, **params)
+            yield records
+            ids = list(dict.fromkeys(x['id'] for x in records))
+            if len(ids) < self.page_size:
+                return
+            after = ids[-1]
+
+    def node_rows(self, label):
+        for records in self.pages(self.node_query, "read_nodes", label):
+            for x in records:
+                yield [x['id'], label, x['preflabel'], x['synonyms'], x['name'], x['description']]
+
+    def label_rows(self, label):
+        for records in self.pages(self.label_query, "read_labels", label, modified=False):
+            for x in records:
+                yield [x['id'], x['preflabel'], x['name']]
+
+    def edge_rows(self, label):
+        # sorted by :START_ID. property_description:IGNORE isn't imported, so it's always empty
+        for records in self.pages(self.edge_query, "read_edges", label, subjects=True):
+            for x in records:
+                if x['type'] is None or x['end'] is None:
+                    continue
+                yield [x['id'], x['type'], x['end']] + [x['props'].get(column) for column in edge_columns[3:]]
+
+    def frames(self, rows, columns, kind):
+        chunk = []
+        for row in rows:
+            chunk.append([frame_value(x) for x in row])
+            if len(chunk) == self.page_size:
+                yield self.frame(chunk, columns, kind)
+                chunk = []
+        if chunk:
+            yield self.frame(chunk, columns, kind)
+
+    def frame(self, chunk, columns, kind):
+        self.metrics.inc("neo4j_rows_read_total", len(chunk), kind=kind)
+        return pd.DataFrame(chunk, columns=columns)
+
+    def node_frames(self):
+        # dataframes of page_size node rows
+        return self.frames(chain.from_iterable(self.node_rows(label) for label in self.labels()), node_columns,
+                           "nodes")
+
+    def label_frames(self):
+        # dataframes of page_size id:ID, preflabel and name rows of all the nodes, whatever the watermark
+        return self.frames(chain.from_iterable(self.label_rows(label) for label in self.labels()),
+                           ["id:ID", "preflabel", "name"], "labels")
+
+    def edge_frames(self):
+        # dataframes of page_size edge rows, sorted by :START_ID
+        rows = heapq.merge(*[self.edge_rows(label) for label in self.labels()], key=lambda row: row[0])
+        return self.frames(rows, edge_columns, "edges")
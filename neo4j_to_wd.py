@@ -1,48 +1,134 @@
-from datetime import datetime
 from itertools import chain
+import csv
+import json
+import os
+import re
+import tempfile
 import configargparse
 
+import numpy as np
 import pandas as pd
+import requests
 from tqdm import tqdm
 from wikidataintegrator import wdi_core, wdi_helpers, wdi_login
-import textwrap
+
+from entity_cache import EntityCache, diff_claims
+from id_map import IdMap
+from id_store import IdStore
+from metrics import Metrics
+from neo4j_backend import Neo4jSource, connect
+from sync_state import Journal, Snapshot
+from write_pipeline import WritePipeline, is_retryable
+
+# a space between two chars that aren't whitespace
+split_point = re.compile(r"(?<=\S) (?=\S)")
 
 
 class Bot:
     equiv_prop_pid = None  # http://www.w3.org/2002/07/owl#equivalentProperty
+    # the most temp files an unsorted edges file is split into. they are all open at once
+    max_buckets = 256
 
     def __init__(self, node_path, edge_path, mediawiki_api_url, sparql_endpoint_url,
-                 login, simulate=False):
+                 login, simulate=False, state_path=None, concurrency=1, rate_limit=None, chunksize=None,
+                 id_store_path=None, journal_path=None, entity_cache_path=None, metrics=None, quiet=False,
+                 source=None):
+        # counters and timers of the run, see metrics.py. quiet: no per item output
+        self.metrics = metrics if metrics else Metrics("neo4j_to_wd")
+        self.quiet = quiet
         self.node_path = node_path
         self.edge_path = edge_path
+        # source: a neo4j_backend.Neo4jSource to read the nodes and edges from instead of the csvs
+        self.source = source
+        if source and source.since is not None and state_path:
+            raise ValueError("a source with a watermark can't be used with a state path")
+        # if chunksize is set, the csvs are streamed in chunks of that many rows instead of being loaded in full.
+        # a source is always streamed
+        self.chunksize = chunksize if chunksize or not source else source.page_size
         self.nodes = None
         self.edges = None
-        self.parse_nodes_edges()
+        self.dupe_label_hashes = None
+        self.edges_sorted = None
+        self.edge_count = None
+        with self.metrics.timer("stage_seconds", stage="parse"):
+            self.parse_nodes_edges()
         self.login = login
+        self.metrics.instrument(self.login.get_session())
         self.write = not simulate
         self.mediawiki_api_url = mediawiki_api_url
         self.sparql_endpoint_url = sparql_endpoint_url
         self.dbxref_pid = None
-
-        self.item_engine = wdi_core.WDItemEngine.wikibase_item_engine_factory(mediawiki_api_url=mediawiki_api_url,
-                                                                              sparql_endpoint_url=sparql_endpoint_url)
-        self.get_equiv_prop_pid()
-        self.uri_pid = wdi_helpers.id_mapper(self.get_equiv_prop_pid(), endpoint=sparql_endpoint_url)
+        self.state_path = state_path
+        self.id_store = IdStore(id_store_path, sparql_endpoint_url) if id_store_path else None
+        self.entity_cache = EntityCache(entity_cache_path) if entity_cache_path else None
+        # nothing to resume in a simulated run
+        self.journal = Journal(journal_path, self.run_id()) if journal_path and self.write else None
+        # writes in create_properties, create_classes, create_nodes and create_edges go through the pipeline
+        self.pipeline = WritePipeline(concurrency=concurrency, rate_limit=rate_limit, metrics=self.metrics)
+        # {stage: curies} whose write failed, or whose statements were dropped for a missing id. a delta run doesn't
+        # count them as synced
+        self.failed = dict()
+        if concurrency > 1:
+            # one pooled connection per worker
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+            self.login.get_session().mount("http://", adapter)
+            self.login.get_session().mount("https://", adapter)
+
+        # {(prop, value): id} of the entities created in this run (or the crashed run being resumed). see id_mapper
+        self.minted = dict(self.journal.minted) if self.journal else dict()
+        self.uri_pid = self.id_mapper(self.get_equiv_prop_pid())
+        self.recover_pending(self.equiv_prop_pid, self.uri_pid)
 
         ####
         # these lines have to be done in this order because we need dbxref first before the others can be created
-        now = datetime.utcnow().replace(microsecond=0)
-        dbxref_pid, created = self.create_dbxref_prop()
+        self.create_dbxref_prop()
         self.dbxref_pid = self.uri_pid['http://www.geneontology.org/formats/oboInOwl#DbXref']
         self.create_initial_props()
-        # this fails on first run because the sparql endpoint has not yet been updated. so we need to wait
-        if created:
-            wdi_helpers.wait_for_last_modified(now, entity="http://wikibase.svc", delay=20,
-                                               endpoint=sparql_endpoint_url)
-        self.dbxref_qid = wdi_helpers.id_mapper(self.dbxref_pid, endpoint=sparql_endpoint_url)
+        # the sparql endpoint may not have the properties we just created yet. no need to wait for it, because
+        # id_mapper adds the ids we minted
+        self.dbxref_qid = self.id_mapper(self.dbxref_pid)
+        self.recover_pending(self.dbxref_pid, self.dbxref_qid)
 
         ####
 
+    def run_id(self):
+        # a journal can only be resumed with the same input files
+        if self.source:
+            return [self.source.run_id()]
+        return [[path, os.path.getsize(path), os.path.getmtime(path)] for path in (self.node_path, self.edge_path)]
+
+    def recover_pending(self, prop, mapping):
+        # entities that the crashed run started creating but didn't record. look them up, so they aren't created twice
+        if not self.journal:
+            return
+        for (p, value), (label, entity_type) in sorted(self.journal.pending.items()):
+            if p != prop or value in mapping:
+                continue
+            eid = self.find_entity(prop, value, label, entity_type)
+            print("pending {} {}: {}".format(entity_type, value, eid if eid else "not created"))
+            if eid:
+                mapping[value] = eid
+                self.record_id(prop, value, eid)
+
+    def find_entity(self, prop, value, label, entity_type):
+        # unlike the sparql endpoint, the label search is up to date as soon as the write is done.
+        # returns the id of the entity with this label and this value for prop, or None
+        params = {'action': 'wbsearchentities', 'search': label, 'language': 'en', 'type': entity_type,
+                  'limit': 50, 'format': 'json'}
+        reply = wdi_core.WDItemEngine.mediawiki_api_call("GET", self.mediawiki_api_url,
+                                                         session=self.login.get_session(), params=params)
+        ids = [x['id'] for x in reply.get('search', [])]
+        if not ids:
+            return None
+        params = {'action': 'wbgetentities', 'ids': "|".join(ids), 'format': 'json'}
+        reply = wdi_core.WDItemEngine.mediawiki_api_call("GET", self.mediawiki_api_url,
+                                                         session=self.login.get_session(), params=params)
+        for eid in ids:
+            claims = reply['entities'].get(eid, dict()).get('claims', dict()).get(prop, [])
+            if any(claim['mainsnak'].get('datavalue', dict()).get('value') == value for claim in claims):
+                return eid
+        return None
+
     def create_dbxref_prop(self):
         # dbxref is special because other props use it
         dbxref_pid, created = self.create_property("External ID",
@@ -66,19 +152,98 @@ class Bot:
         self.create_property("type", "the neo4j type, aka ':LABEL'", "wikibase-item", "http://type", "type")
 
     def run(self, force=False):
-        self.create_properties()
-        self.create_classes()
-        self.create_nodes(force=force)
-        self.create_edges()
+        if self.state_path:
+            self.run_delta(force=force)
+            return
+        if self.source and self.source.since is not None:
+            self.run_modified()
+            return
+        self.run_stage("properties", self.create_properties)
+        self.run_stage("classes", self.create_classes)
+        self.run_stage("nodes", self.create_nodes, force=force)
+        self.run_stage("edges", self.create_edges)
+        self.pipeline.close()
+        if self.journal:
+            self.journal.remove()
+
+    def run_delta(self, force=False):
+        # only write the nodes and edges that changed since the snapshot saved by the last run
+        with self.metrics.timer("stage_seconds", stage="diff"):
+            old = Snapshot.load(self.state_path)
+            new = Snapshot.from_frames(self.node_frames(), self.edge_frames())
+            added, changed, removed = old.diff_nodes(new)
+            subjects, removed_props = old.diff_edges(new)
+            # edges to or from a node that didn't exist yet were skipped, so those subjects have to be redone
+            for edges in self.edge_frames():
+                subjects |= set(edges.loc[edges[':START_ID'].isin(added) | edges[':END_ID'].isin(added),
+                                          ':START_ID'])
+        print("nodes added: {}, changed: {}, removed: {}. subjects with changed edges: {}".format(
+            len(added), len(changed), len(removed), len(subjects)))
+
+        self.run_stage("properties", self.create_properties)
+        self.run_stage("classes", self.create_classes)
+        self.run_stage("nodes", self.create_nodes, force=force, curies=added)
+        self.run_stage("updated_nodes", self.create_nodes, curies=changed, update=True)
+        self.run_stage("deleted_nodes", self.delete_nodes, removed)
+        self.run_stage("edges", self.create_edges, subjects=subjects, removed_props=removed_props)
+        self.pipeline.close()
+        if self.write:
+            # removed nodes are remembered, so they are updated rather than created if they come back
+            new.nodes.update((k, None) for k, v in old.nodes.items() if k not in new.nodes)
+            # what failed keeps its old hash (or none), so the next run tries it again
+            for curie in self.failed.get("deleted_nodes", ()):
+                new.nodes[curie] = old.nodes[curie]
+            for subj in self.failed.get("edges", ()):
+                if subj in old.edges:
+                    new.edges[subj] = old.edges[subj]
+                else:
+                    new.edges.pop(subj, None)
+            new.save(self.state_path)
+        if self.journal:
+            self.journal.remove()
+
+    def run_modified(self):
+        # the source only has the nodes and the subjects modified since its watermark: update those nodes and rewrite
+        # the edges of those subjects. nodes and relationships deleted from neo4j aren't seen
+        self.run_stage("properties", self.create_properties)
+        self.run_stage("classes", self.create_classes)
+        self.run_stage("updated_nodes", self.create_nodes, update=True)
+        self.run_stage("edges", self.create_edges)
+        self.pipeline.close()
+        if self.journal:
+            self.journal.remove()
+
+    def run_stage(self, stage, f, *args, **kwargs):
+        # stages that the run being resumed finished are skipped
+        if self.journal and stage in self.journal.stages:
+            print("skipping finished stage: {}".format(stage))
+            return
+        with self.metrics.timer("stage_seconds", stage=stage):
+            f(*args, **kwargs)
+        if self.journal:
+            self.journal.append("stage", stage)
+        self.metrics.write()
+
+    def is_done(self, stage, key):
+        done = self.journal is not None and (stage, key) in self.journal.done
+        if done:
+            self.metrics.inc("resumed_skips_total", stage=stage)
+        return done
+
+    def mark_done(self, stage, key):
+        if self.journal:
+            self.journal.append("done", stage, key)
 
     def create_properties(self):
         # Reads the neo4j edges file to determine properties it needs to create
-        edges = self.edges
-        # make sure this edges we need exist
-        curie_label = dict(zip(edges[':TYPE'], edges['property_label']))
+        curie_label = dict()
+        curie_uri = dict()
+        for edges in self.edge_frames():
+            # make sure this edges we need exist
+            curie_label.update(zip(edges[':TYPE'], edges['property_label']))
+            curie_uri.update(zip(edges[':TYPE'], edges['property_uri']))
         curie_label = {k: v for k, v in curie_label.items() if k}
         curie_label = {k: v if v else k for k, v in curie_label.items()}
-        curie_uri = dict(zip(edges[':TYPE'], edges['property_uri']))
 
         # hard coding these because they're missing or wrong in the edges file
         curie_uri['colocalizes_with'] = "http://purl.obolibrary.org/obo/RO_0002325"
@@ -88,42 +253,170 @@ class Bot:
         # all edges will be an item except for skos:exactMatch
         if 'skos:exactMatch' in curie_label:
             del curie_label['skos:exactMatch']
+        # one write per uri, even if several curies have the same uri
+        uri_curie_label = dict()
         for curie, label in curie_label.items():
-            self.create_property(label, "", "wikibase-item", curie_uri[curie], curie)
+            uri_curie_label.setdefault(curie_uri[curie], (curie, label))
+        for uri, (curie, label) in uri_curie_label.items():
+            self.pipeline.submit(self.create_property, label, "", "wikibase-item", uri, curie)
+        self.pipeline.join()
 
     def create_property(self, label, description, property_datatype, uri, dbxref):
         # returns tuple (property PID: str, created: bool)
         if uri in self.uri_pid:
-            print("property already exists: {} {}".format(self.uri_pid[uri], uri))
+            self.metrics.inc("properties_total", result="exists")
+            if not self.quiet:
+                print("property already exists: {} {}".format(self.uri_pid[uri], uri))
             return (self.uri_pid[uri], False)
         s = [wdi_core.WDUrl(uri, self.get_equiv_prop_pid())]
         if self.dbxref_pid:
             s.append(wdi_core.WDString(dbxref, self.dbxref_pid))
-        item = self.item_engine(item_name=label, domain="foo", data=s, core_props=[self.equiv_prop_pid])
-        item.set_label(label)
-        item.set_description(description)
+        pid = ""
         if self.write:
-            item.write(self.login, entity_type="property", property_datatype=property_datatype)
-        self.uri_pid[uri] = item.wd_item_id
+            if self.journal:
+                self.journal.append("pending", self.equiv_prop_pid, uri, label, "property")
+            data = self.entity_data(label, description or None, None, diff_claims(dict(), s))
+            data['datatype'] = property_datatype
+            pid = self.edit_entity(data, entity_type="property")['id']
+            self.record_id(self.equiv_prop_pid, uri, pid)
+            if self.dbxref_pid:
+                self.record_id(self.dbxref_pid, dbxref, pid)
+            self.metrics.inc("properties_total", result="created")
+        self.uri_pid[uri] = pid
         return (self.uri_pid[uri], True)
 
-    def create_item(self, label, description, ext_id, synonyms=None, type_of=None, force=False):
-        if (not force) and ext_id in self.dbxref_qid:
-            print("item already exists: {} {}".format(self.dbxref_qid[ext_id], ext_id))
+    def create_item(self, label, description, ext_id, synonyms=None, type_of=None, force=False, update=False):
+        # if update is True, an existing item gets its label, description, aliases and type overwritten.
+        # if force is True, an existing item gets them too, but its aliases are added to
+        if (not force) and (not update) and self.item_exists(ext_id):
+            return None
+        if update and self.is_done("updated_nodes", ext_id):
             return None
         s = [wdi_core.WDString(ext_id, self.dbxref_pid)]
         if type_of:
             s.append(wdi_core.WDItemID(self.dbxref_qid[type_of], self.uri_pid['http://type']))
 
-        item = self.item_engine(item_name=label, domain="foo", data=s, core_props=[self.dbxref_pid])
-        item.set_label(label)
-        if description:
-            item.set_description(description)
-        if synonyms:
-            item.set_aliases(synonyms)
+        qid = self.dbxref_qid.get(ext_id) if force or update else None
+        # the labels and aliases aren't in the entity cache, so an existing item is always read
+        entity = self.read_entity(qid, props='info|labels|descriptions|aliases|claims') if qid else dict()
+        aliases = None
+        if qid and update:
+            # an empty description or no synonyms clear what the item had
+            aliases = sorted(synonyms or [])
+            description = description or ""
+        elif synonyms:
+            current = [x['value'] for x in entity.get('aliases', dict()).get('en', [])]
+            aliases = current + sorted(set(synonyms) - set(current))
+        elif not description:
+            description = None
+        data = self.entity_data(label, description, aliases, diff_claims(entity.get('claims', dict()), s))
+        if qid and self.unchanged(entity, data):
+            self.metrics.inc("items_total", result="unchanged")
+            if update:
+                self.mark_done("updated_nodes", ext_id)
+            return None
         if self.write:
-            item.write(self.login)
-        self.dbxref_qid[ext_id] = item.wd_item_id
+            created = not qid
+            if created and self.journal:
+                self.journal.append("pending", self.dbxref_pid, ext_id, label, "item")
+            qid = self.edit_entity(data, qid, entity.get('lastrevid'))['id']
+            if created:
+                self.record_id(self.dbxref_pid, ext_id, qid)
+            elif update:
+                self.mark_done("updated_nodes", ext_id)
+            self.metrics.inc("items_total", result="created" if created else "updated")
+        self.dbxref_qid[ext_id] = qid if qid else ""
+
+    def item_exists(self, ext_id):
+        # whether there's an item for ext_id already, in which case create_item has nothing to do unless forced
+        if ext_id not in self.dbxref_qid:
+            return False
+        self.metrics.inc("items_total", result="exists")
+        if not self.quiet:
+            print("item already exists: {} {}".format(self.dbxref_qid[ext_id], ext_id))
+        return True
+
+    @staticmethod
+    def entity_data(label, description, aliases, claims):
+        # the wbeditentity data of an entity with an english label, description and aliases
+        # a description of "" removes the item's description. description=None leaves it as it is
+        data = {'labels': {'en': {'language': 'en', 'value': label}}, 'claims': claims}
+        if description is not None:
+            data['descriptions'] = {'en': {'language': 'en', 'value': description}}
+        if aliases is not None:
+            data['aliases'] = {'en': [{'language': 'en', 'value': x} for x in aliases]}
+        return data
+
+    @staticmethod
+    def unchanged(entity, data):
+        # whether writing data would leave entity as it is
+        if data['claims']:
+            return False
+        for key in ('labels', 'descriptions'):
+            if key in data and entity.get(key, dict()).get('en', dict()).get('value', "") != data[key]['en']['value']:
+                return False
+        current = [x['value'] for x in entity.get('aliases', dict()).get('en', [])]
+        return 'aliases' not in data or current == [x['value'] for x in data['aliases']['en']]
+
+    def read_entity(self, eid, props='info|claims'):
+        params = {'action': 'wbgetentities', 'ids': eid, 'props': props, 'format': 'json'}
+        reply = wdi_core.WDItemEngine.mediawiki_api_call("GET", self.mediawiki_api_url,
+                                                         session=self.login.get_session(), params=params)
+        return reply['entities'][eid]
+
+    def edit_entity(self, data, eid=None, baserevid=None, entity_type="item"):
+        """
+        Sends data with wbeditentity, to the entity eid or else to a new entity of entity_type. Returns the entity in
+        the reply.
+        Writes in the pipeline's threads go through here rather than through an item engine, whose parsing of claims
+        (WDBaseDataType.from_json) isn't thread safe.
+        """
+        payload = {
+            'action': 'wbeditentity',
+            'data': json.dumps(data),
+            'format': 'json',
+            'token': self.login.get_edit_token(),
+            'bot': '',
+            'maxlag': wdi_core.config['MAXLAG']
+        }
+        if eid:
+            payload['id'] = eid
+            if baserevid:
+                payload['baserevid'] = baserevid
+        else:
+            payload['new'] = entity_type
+        self.pipeline.rate_limiter.wait()
+        try:
+            reply = wdi_core.WDItemEngine.mediawiki_api_call("POST", self.mediawiki_api_url,
+                                                             session=self.login.get_session(), data=payload)
+            if 'error' in reply:
+                raise wdi_core.WDApiError(reply)
+        except Exception:
+            # e.g. an edit conflict because the cached entity is out of date. it gets read again on retry
+            if eid and self.entity_cache:
+                self.entity_cache.invalidate(eid)
+            raise
+        if self.entity_cache:
+            self.entity_cache.put(reply['entity']['id'], reply['entity'])
+        return reply['entity']
+
+    def id_mapper(self, prop):
+        # the sparql endpoint lags behind writes, so the entities minted in this run are put on top of its results
+        with self.metrics.timer("id_mapper_seconds", prop=prop):
+            if self.id_store:
+                mapping = self.id_store.id_mapper(prop)
+            else:
+                mapping = IdMap(wdi_helpers.id_mapper(prop, endpoint=self.sparql_endpoint_url) or dict())
+        mapping.update({value: eid for (p, value), eid in self.minted.items() if p == prop})
+        return mapping
+
+    def record_id(self, prop, value, eid):
+        # keep track of the entities we create
+        self.minted[(prop, value)] = eid
+        if self.journal:
+            self.journal.append("minted", prop, value, eid)
+        if self.id_store:
+            self.id_store.record(prop, value, eid)
 
     def get_equiv_prop_pid(self):
         if self.equiv_prop_pid:
@@ -141,75 +434,168 @@ class Bot:
 
     def create_classes(self):
         # from the nodes file, get the "type", which neo4j calls ":LABEL" for some strange reason
-        types = set(self.nodes[':LABEL'])
+        types = set()
+        for nodes in self.node_frames():
+            types.update(nodes[':LABEL'])
         for t in types:
-            self.create_item(t, "", t)
-
-    def create_nodes(self, force=False):
-        nodes = self.nodes
-        curie_label = dict(zip(nodes['id:ID'], nodes['preflabel']))
-        curie_label = {k: v for k, v in curie_label.items() if k}
-        curie_label = {k: v if v else k for k, v in curie_label.items()}
-        curie_synonyms = dict(zip(nodes['id:ID'], nodes['synonyms:IGNORE'].map(lambda x: x.split("|") if x else [])))
-        curie_descr = dict(zip(nodes['id:ID'], nodes['description']))
-        curie_name = dict(zip(nodes['id:ID'], nodes['name']))
-        curie_type = dict(zip(nodes['id:ID'], nodes[':LABEL']))
-
-        curie_label = sorted(curie_label.items(), key=lambda x: x[0])
-        t = tqdm(curie_label)
-        for curie, label in t:
-            t.set_description(label)
-            if len(curie) > 100:
+            # existing items are skipped here rather than in a task, which would wait for the rate limit
+            if not self.item_exists(t):
+                self.pipeline.submit(self.create_item, t, "", t)
+        self.pipeline.join()
+
+    def create_nodes(self, force=False, curies=None, update=False):
+        # curies: only create these nodes
+        t = tqdm(total=None if self.chunksize else len(self.nodes), disable=self.quiet)
+        for nodes in self.node_frames():
+            if curies is not None:
+                nodes = nodes[nodes['id:ID'].isin(curies)]
+            curie_label = dict(zip(nodes['id:ID'], nodes['preflabel']))
+            curie_label = {k: v for k, v in curie_label.items() if k}
+            curie_label = {k: v if v else k for k, v in curie_label.items()}
+            curie_synonyms = dict(zip(nodes['id:ID'],
+                                      nodes['synonyms:IGNORE'].map(lambda x: x.split("|") if x else [])))
+            curie_descr = dict(zip(nodes['id:ID'], nodes['description']))
+            curie_name = dict(zip(nodes['id:ID'], nodes['name']))
+            curie_type = dict(zip(nodes['id:ID'], nodes[':LABEL']))
+
+            curie_label = sorted(curie_label.items(), key=lambda x: x[0])
+            for curie, label in curie_label:
+                t.set_description(label)
+                t.update(1)
+                if len(curie) > 100:
+                    self.metrics.inc("items_total", result="skipped")
+                    continue
+                if not force and not update and self.item_exists(curie):
+                    continue
+                synonyms = (set(curie_synonyms[curie]) | {curie_name[curie]}) - {label} - {''}
+                self.pipeline.submit(self.create_item, label, curie_descr[curie], curie, synonyms=synonyms,
+                                     type_of=curie_type[curie], force=force, update=update)
+        t.close()
+        self.pipeline.join()
+
+    def delete_nodes(self, curies):
+        # a node that is gone from the nodes file loses its type, so wd_to_neo4j no longer exports it.
+        # its edges are removed by create_edges. the item itself (and its dbxref) is kept, so the QID
+        # gets reused if the node comes back
+        for curie in tqdm(sorted(curies), disable=self.quiet):
+            qid = self.dbxref_qid.get(curie)
+            if not qid or self.is_done("deleted_nodes", curie):
                 continue
-            synonyms = (set(curie_synonyms[curie]) | {curie_name[curie]}) - {label} - {''}
-            self.create_item(label, curie_descr[curie], curie, synonyms=synonyms,
-                             type_of=curie_type[curie], force=force)
-
-    def create_edges(self):
-        edges = self.edges
-
-        subj_edges = edges.groupby(":START_ID")
-
-        # subj, rows = "UniProt:Q96IV0", edges[edges[':START_ID']=='ClinVarVariant:50962']
-        for subj, rows in tqdm(subj_edges, total=len(subj_edges)):
-            subj = self.dbxref_qid.get(rows.iloc[0][':START_ID'])
-            ss = self.create_subj_edges(rows)
-            if not ss:
+            s = [wdi_core.WDBaseDataType.delete_statement(self.uri_pid['http://type'])]
+            self.pipeline.submit(self.try_write, qid, s, curie, stage="deleted_nodes")
+        self.pipeline.join()
+
+    def create_edges(self, subjects=None, removed_props=None):
+        # subjects: only write the edges of these subjects
+        # removed_props: {subject curie: property uris}. statements with these properties are deleted from the subject
+        removed_props = removed_props if removed_props else dict()
+        # subjects in removed_props that still have edges
+        seen = set()
+
+        for subj, statements in tqdm(self.subject_edges(subjects), disable=self.quiet):
+            if self.is_done("edges", subj):
+                seen.add(subj)
                 continue
-            item = self.item_engine(wd_item_id=subj, data=ss, domain="asdf")
-            wdi_helpers.try_write(item, rows.iloc[0][':START_ID'], self.dbxref_pid, self.login, write=self.write)
-
-    def create_subj_edges(self, rows):
-        # input is a dataframe where all the subjects are the same
+            ss = self.create_subj_edges(subj, statements)
+            if subj in removed_props:
+                ss.extend(self.delete_statements(removed_props[subj]))
+                seen.add(subj)
+            self.write_subj_edges(subj, ss)
+
+        # subjects that don't have any edges left
+        for subj in sorted(set(removed_props) - seen):
+            if self.is_done("edges", subj):
+                continue
+            self.write_subj_edges(subj, self.delete_statements(removed_props[subj]))
+        self.pipeline.join()
+
+    def write_subj_edges(self, subj_curie, ss):
+        subj = self.dbxref_qid.get(subj_curie)
+        if ss and not subj:
+            self.add_failed("edges", subj_curie)
+        if not (ss and subj):
+            return
+        self.pipeline.submit(self.try_write, subj, ss, subj_curie, stage="edges")
+
+    def try_write(self, qid, ss, curie, stage=None):
+        # runs in the write pipeline. logs and swallows errors, like wdi_helpers.try_write. except for the ones worth
+        # retrying, which are re-raised
+        try:
+            changed = self.write_statements(qid, ss)
+        except Exception as e:
+            if is_retryable(e):
+                raise
+            self.metrics.inc("edits_total", stage=stage, result="error")
+            self.add_failed(stage, curie)
+            wdi_core.WDItemEngine.log("ERROR", wdi_helpers.format_msg(curie, self.dbxref_pid, qid, str(e), type(e)))
+            return
+        wdi_core.WDItemEngine.log("INFO", wdi_helpers.format_msg(curie, self.dbxref_pid, qid,
+                                                                 "UPDATE" if changed else "SKIP"))
+        self.metrics.inc("edits_total", stage=stage, result="updated" if changed else "unchanged")
+        if stage:
+            self.mark_done(stage, curie)
+
+    def add_failed(self, stage, curie):
+        # dict.setdefault and set.add are atomic, so this is safe from the pipeline's threads
+        self.failed.setdefault(stage, set()).add(curie)
+
+    def write_statements(self, qid, ss):
+        # only the claims that differ from the item's current claims are sent. if none do, nothing is written.
+        # the current claims come from the entity cache, or else are read from the wikibase.
+        # returns True if the item needed a change
+        entity = self.entity_cache.get(qid) if self.entity_cache else None
+        if self.entity_cache:
+            self.metrics.inc("entity_cache_total", result="miss" if entity is None else "hit")
+        if entity is None:
+            entity = self.read_entity(qid)
+            if self.entity_cache:
+                self.entity_cache.put(qid, entity)
+        edits = diff_claims(entity.get('claims', dict()), ss)
+        if not (edits and self.write):
+            return bool(edits)
+
+        self.edit_entity({'claims': edits}, qid, entity['lastrevid'])
+        self.metrics.inc("claims_sent_total", sum(len(x) for x in edits.values()))
+        return True
+
+    def delete_statements(self, prop_uris):
+        # statements that delete every value of a property from an item
+        pids = [self.uri_pid.get(uri) for uri in prop_uris] if prop_uris else []
+        return [wdi_core.WDBaseDataType.delete_statement(pid) for pid in sorted(filter(None, pids))]
+
+    def create_subj_edges(self, subj, statements):
+        # input is the statement bundle of one subject (see edge_bundles)
         # i.e. write to one item
-        spo_edges = rows.groupby([":START_ID", ":TYPE", ":END_ID"])
-        # spo, spo_rows = ('UniProt:Q96IV0', 'RO:0002331', 'GO:0006517'), rows[rows[':END_ID'] == 'GO:0006517']
+        # subj = 'UniProt:Q96IV0'
+        # statements = [('RO:0002331', 'GO:0006517', 'http://purl.obolibrary.org/obo/RO_0002331',
+        #                [('https://www.ncbi.nlm.nih.gov/pubmed/123', 'supporting text')])]
         ss = []
-        for spo, spo_rows in spo_edges:
-            refs = self.create_statement_ref(spo_rows)
-            s = self.create_statement(spo_rows.iloc[0])
+        for prop_curie, obj, prop_uri, ref_rows in statements:
+            s = self.create_statement(subj, prop_curie, obj, prop_uri)
             if not s:
+                self.add_failed("edges", subj)
                 continue
-            s.references = refs
+            s.references = self.create_statement_ref(ref_rows)
             ss.append(s)
         return ss
 
     # noinspection PyTypeChecker
-    def create_statement_ref(self, rows):
+    def create_statement_ref(self, ref_rows):
         """
-        Ref supporting text gets split up into chunks of 400 chars each.
+        Ref supporting text gets split up into chunks of 400 chars each (see split_text).
         if the ref url is from pubmed, it gets split. Otherwise it gets cropped to 400 chars
+        ref_rows is a list of (reference_uri, reference_supporting_text) tuples. one reference for each.
+        wd_to_neo4j.py undoes this with " ".join() and join_ref_urls
         """
 
         ref_url_pid = self.uri_pid['http://www.wikidata.org/entity/P854']
         ref_supp_text_pid = self.uri_pid['http://reference_supporting_text']
         refs = []
-        for _, row in rows.iterrows():
-            # textwrap.wrap splits lines on spaces only
-            lines = textwrap.wrap(row.reference_supporting_text, 400, break_long_words=False)
+        for reference_uri, reference_supporting_text in ref_rows:
+            lines = self.split_text(reference_supporting_text)
             ref = [wdi_core.WDString(rst_chunk, ref_supp_text_pid, is_reference=True) for rst_chunk in lines]
-            if row.reference_uri:
-                for ref_uri in row.reference_uri.split("|"):
+            if reference_uri:
+                for ref_uri in reference_uri.split("|"):
                     ref_uri = self.handle_special_ref_url(ref_uri)
                     if ref_uri.startswith("https://www.ncbi.nlm.nih.gov/pubmed/"):
                         ref.extend([wdi_core.WDUrl(this_url, ref_url_pid, is_reference=True)
@@ -219,18 +605,18 @@ class Bot:
             refs.append(ref)
         return refs
 
-    def create_statement(self, row):
-        subj = self.dbxref_qid.get(row[':START_ID'])
-        pred = self.uri_pid.get(row['property_uri'])
-        if row[':TYPE'] == "skos:exactMatch":
-            obj = row[':END_ID']
+    def create_statement(self, subj_curie, prop_curie, obj_curie, prop_uri):
+        subj = self.dbxref_qid.get(subj_curie)
+        pred = self.uri_pid.get(prop_uri)
+        if prop_curie == "skos:exactMatch":
+            obj = obj_curie
         else:
-            obj = self.dbxref_qid.get(row[':END_ID'])
+            obj = self.dbxref_qid.get(obj_curie)
 
         # print(subj, pred, obj)
         if not (subj and pred and obj):
             return None
-        if row[':TYPE'] == "skos:exactMatch":
+        if prop_curie == "skos:exactMatch":
             s = wdi_core.WDString(obj, pred)
         else:
             s = wdi_core.WDItemID(obj, pred)
@@ -243,6 +629,43 @@ class Bot:
             url = "https://www.wikidata.org/wiki/Special:BookSources/{}".format(isbn)
         return url
 
+    @staticmethod
+    def undo_special_ref_url(url):
+        # "ISBN-10" leaves its ":" in the book sources url, so both prefixes can be told apart
+        base_url = "https://www.wikidata.org/wiki/Special:BookSources/"
+        if not url.startswith(base_url):
+            return url
+        isbn = url[len(base_url):]
+        if isbn.startswith(":"):
+            return "ISBN-10" + isbn
+        return isbn if isbn.startswith("ISBN") else "ISBN-13:" + isbn
+
+    @staticmethod
+    def split_text(text, width=400):
+        """
+        Split a reference supporting text into chunks of up to width chars (more if a word is longer), so that
+        " ".join(chunks) gives it back. Wikibase strings can't contain tabs or line breaks, or start or end with
+        whitespace, so these are replaced by spaces and stripped first. The text is only split at a single space.
+        """
+        text = re.sub(r"[\t\n\r\v\f]", " ", text).strip()
+        chunks = []
+        while len(text) > width:
+            # the last split point that leaves at most width chars in the chunk, or else the first one
+            i = None
+            for m in split_point.finditer(text, 0, width + 2):
+                if m.start() <= width:
+                    i = m.start()
+            if i is None:
+                m = split_point.search(text, width + 1)
+                if not m:
+                    break
+                i = m.start()
+            chunks.append(text[:i])
+            text = text[i + 1:]
+        if text:
+            chunks.append(text)
+        return chunks
+
     @staticmethod
     def split_pubmed_url(url):
         base_url = "https://www.ncbi.nlm.nih.gov/pubmed/"
@@ -270,7 +693,25 @@ class Bot:
 
         return url
 
+    @staticmethod
+    def join_ref_urls(urls):
+        # the reference_uris of a reference's urls. split_pubmed_url only starts a new url when the last one is full,
+        # so a pubmed url continues the one before if that one had no room for its first pmid
+        base_url = "https://www.ncbi.nlm.nih.gov/pubmed/"
+        ref_uris = []
+        last = None
+        for url in urls:
+            if last and url.startswith(base_url) and len(last) + len(url[len(base_url):].split(",")[0]) + 1 >= 400:
+                ref_uris[-1] = Bot.join_pubmed_url([ref_uris[-1], url])
+            else:
+                ref_uris.append(Bot.undo_special_ref_url(url))
+            last = url if url.startswith(base_url) else None
+        return ref_uris
+
     def parse_nodes_edges(self):
+        if self.chunksize:
+            self.index_nodes_edges()
+            return
         node_path, edge_path = self.node_path, self.edge_path
         edges = pd.read_csv(edge_path, dtype=str)
         edges = edges.fillna("")
@@ -285,9 +726,7 @@ class Bot:
         nodes = nodes[nodes['id:ID'].isin(s)]
         """
 
-        # handle nodes with no label
-        blank = (nodes.preflabel == "") & (nodes.name == "")
-        nodes.loc[blank, "preflabel"] = nodes.loc[blank, "id:ID"]
+        nodes = self.fill_blank_labels(nodes)
 
         # handle non-unique labels
         dupe = nodes.duplicated(subset=['preflabel'], keep=False)
@@ -296,11 +735,205 @@ class Bot:
 
         self.nodes, self.edges = nodes, edges
 
+    @staticmethod
+    def fill_blank_labels(nodes):
+        # handle nodes with no label
+        blank = (nodes.preflabel == "") & (nodes.name == "")
+        nodes.loc[blank, "preflabel"] = nodes.loc[blank, "id:ID"]
+        return nodes
 
-def main(user, password, mediawiki_api_url, sparql_endpoint_url, node_path, edge_path, simulate=False):
+    @staticmethod
+    def label_hashes(nodes):
+        return pd.util.hash_pandas_object(nodes.preflabel, index=False).values
+
+    def node_chunks(self):
+        return self.source.node_frames() if self.source else self.read_chunks(self.node_path)
+
+    def label_chunks(self):
+        # the labels of all the nodes, even when the source only has the modified ones
+        return self.source.label_frames() if self.source else self.read_chunks(self.node_path)
+
+    def edge_chunks(self):
+        return self.source.edge_frames() if self.source else self.read_chunks(self.edge_path)
+
+    def read_chunks(self, path):
+        for chunk in pd.read_csv(path, dtype=str, chunksize=self.chunksize):
+            chunk = chunk.fillna("")
+            yield chunk.replace('None', "")
+
+    def index_nodes_edges(self):
+        # streaming mode pre-pass. instead of loading the files, only keep what's needed to stream them later:
+        # the 64-bit hashes of the labels that occur more than once, and whether the edges are sorted by subject
+        label_hashes = [np.array([], dtype=np.uint64)]
+        for nodes in self.label_chunks():
+            label_hashes.append(self.label_hashes(self.fill_blank_labels(nodes)))
+        label_hashes, counts = np.unique(np.concatenate(label_hashes), return_counts=True)
+        self.dupe_label_hashes = label_hashes[counts > 1]
+
+        self.edges_sorted = True
+        if self.source:
+            # the source merges its labels' edges by :START_ID, so there's no need to read them all to check
+            return
+        self.edge_count = 0
+        last_subj = None
+        for edges in self.edge_chunks():
+            if edges.empty:
+                continue
+            subj = edges[':START_ID'].values
+            if (last_subj is not None and subj[0] < last_subj) or (subj[1:] < subj[:-1]).any():
+                self.edges_sorted = False
+            last_subj = subj[-1]
+            self.edge_count += len(edges)
+
+    def node_frames(self):
+        # yields the nodes dataframe, or its chunks in streaming mode
+        if not self.chunksize:
+            yield self.nodes
+            return
+        for nodes in self.node_chunks():
+            nodes = self.fill_blank_labels(nodes)
+            # handle non-unique labels
+            dupe = np.isin(self.label_hashes(nodes), self.dupe_label_hashes)
+            # append the ID to the label
+            nodes.loc[dupe, "preflabel"] = nodes.loc[dupe, "preflabel"] + " (" + nodes.loc[dupe, "id:ID"] + ")"
+            yield nodes
+
+    def edge_frames(self):
+        # yields the edges dataframe, or its chunks in streaming mode
+        if not self.chunksize:
+            yield self.edges
+            return
+        yield from self.edge_chunks()
+
+    @staticmethod
+    def edge_bundles(edges):
+        # sorts the edges once and cuts them into statement bundles, so no dataframe is touched per subject.
+        # yields (subject curie, statements) for each subject, where statements is a list of
+        # (:TYPE, :END_ID, property_uri, [(reference_uri, reference_supporting_text), ...]) tuples,
+        # one for each distinct (:START_ID, :TYPE, :END_ID), with one (reference_uri, ...) tuple per edge row
+        edges = edges.sort_values([":START_ID", ":TYPE", ":END_ID"], kind='mergesort')
+        subj, prop, obj, prop_uri, ref_uri, ref_text = (edges[x].values for x in (
+            ':START_ID', ':TYPE', ':END_ID', 'property_uri', 'reference_uri', 'reference_supporting_text'))
+        n = len(edges)
+        if not n:
+            return
+        # row positions where a new subject starts, and where a new (subj, prop, obj) statement starts
+        subj_change = subj[1:] != subj[:-1]
+        subj_starts = np.flatnonzero(np.concatenate([[True], subj_change]))
+        spo_starts = np.flatnonzero(np.concatenate([[True], subj_change | (prop[1:] != prop[:-1]) |
+                                                    (obj[1:] != obj[:-1])]))
+        spo_ends = np.append(spo_starts[1:], n)
+        # index into spo_starts of the first statement of each subject
+        subj_spo = np.append(np.searchsorted(spo_starts, subj_starts), len(spo_starts))
+
+        for i, start in enumerate(subj_starts):
+            spo = slice(subj_spo[i], subj_spo[i + 1])
+            statements = [(prop[a], obj[a], prop_uri[a], list(zip(ref_uri[a:b], ref_text[a:b])))
+                          for a, b in zip(spo_starts[spo], spo_ends[spo])]
+            yield subj[start], statements
+
+    def subject_edges(self, subjects=None):
+        # yields (subject curie, statement bundle of that subject). see edge_bundles
+        # subjects: only yield these subjects
+        if not self.chunksize:
+            edges = self.edges
+            if subjects is not None:
+                edges = edges[edges[':START_ID'].isin(subjects)]
+            yield from self.edge_bundles(edges)
+        elif self.edges_sorted:
+            # a subject's edges can span two chunks, so the last subject of a chunk is held back
+            rest = None
+            for edges in self.edge_frames():
+                if subjects is not None:
+                    edges = edges[edges[':START_ID'].isin(subjects)]
+                if rest is not None:
+                    edges = pd.concat([rest, edges])
+                if edges.empty:
+                    continue
+                is_last = edges[':START_ID'] == edges[':START_ID'].iloc[-1]
+                yield from self.edge_bundles(edges[~is_last])
+                rest = edges[is_last]
+            if rest is not None:
+                yield from self.edge_bundles(rest)
+        else:
+            yield from self.bucketed_subject_edges(subjects)
+
+    def bucketed_subject_edges(self, subjects=None):
+        # the edges file isn't sorted by subject. split it up by subject into temp files of about chunksize rows
+        # (or max_buckets bigger ones), so that every subject is in exactly one of them and each one can be grouped
+        # in memory. the files stay open while the edges are split, so this is one pass of appends
+        n_buckets = min(self.max_buckets, max(1, self.edge_count // self.chunksize))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [os.path.join(tmp_dir, "{}.csv".format(n)) for n in range(n_buckets)]
+            files = [open(path, "w", newline="") for path in paths]
+            try:
+                writers = [csv.writer(f) for f in files]
+                columns = None
+                for edges in self.edge_frames():
+                    if subjects is not None:
+                        edges = edges[edges[':START_ID'].isin(subjects)]
+                    if columns is None:
+                        columns = list(edges.columns)
+                        for writer in writers:
+                            writer.writerow(columns)
+                    hashes = pd.util.hash_pandas_object(edges[':START_ID'], index=False).values
+                    buckets = (hashes % n_buckets).astype(np.int64)
+                    # the rows grouped by bucket, and where each bucket's rows start and end
+                    order = np.argsort(buckets, kind='stable')
+                    rows = edges[columns].values[order]
+                    bounds = np.searchsorted(buckets[order], np.arange(n_buckets + 1))
+                    for bucket in np.flatnonzero(np.diff(bounds)):
+                        writers[bucket].writerows(rows[bounds[bucket]:bounds[bucket + 1]].tolist())
+            finally:
+                for f in files:
+                    f.close()
+            if columns is None:
+                return
+            for path in paths:
+                edges = pd.read_csv(path, dtype=str, keep_default_na=False)
+                yield from self.edge_bundles(edges)
+
+
+def main(user, password, mediawiki_api_url, sparql_endpoint_url, node_path=None, edge_path=None, simulate=False,
+         state_path=None, concurrency=1, rate_limit=None, chunksize=None, id_store_path=None, journal_path=None,
+         entity_cache_path=None, metrics_path=None, metrics_format="jsonl", metrics_interval=60, quiet=False,
+         neo4j_uri=None, neo4j_user=None, neo4j_password=None, neo4j_database=None, neo4j_page_size=10000,
+         neo4j_modified_property=None, neo4j_watermark_path=None):
+    if not (neo4j_uri or (node_path and edge_path)):
+        raise ValueError("either the csv paths or a neo4j uri are needed")
+    if neo4j_watermark_path and not (neo4j_uri and neo4j_modified_property):
+        raise ValueError("a watermark path needs a neo4j uri and a modified property")
+    if neo4j_watermark_path and state_path:
+        raise ValueError("a watermark path can't be used with a state path")
+    # the watermark is the neo4j time the last successful run started at
+    since = None
+    if neo4j_watermark_path and os.path.exists(neo4j_watermark_path):
+        with open(neo4j_watermark_path) as f:
+            since = int(f.read())
     login = wdi_login.WDLogin(user=user, pwd=password, mediawiki_api_url=mediawiki_api_url)
-    bot = Bot(node_path, edge_path, mediawiki_api_url, sparql_endpoint_url, login, simulate=simulate)
-    bot.run(force=False)
+    metrics = Metrics("neo4j_to_wd", metrics_path, metrics_format, metrics_interval)
+    metrics.start()
+    driver = connect(neo4j_uri, neo4j_user, neo4j_password) if neo4j_uri else None
+    source = None
+    try:
+        if driver:
+            source = Neo4jSource(driver, database=neo4j_database, page_size=neo4j_page_size,
+                                 modified_property=neo4j_modified_property, since=since, metrics=metrics)
+            started = source.server_time()
+        bot = Bot(node_path, edge_path, mediawiki_api_url, sparql_endpoint_url, login, simulate=simulate,
+                  state_path=state_path, concurrency=concurrency, rate_limit=rate_limit, chunksize=chunksize,
+                  id_store_path=id_store_path, journal_path=journal_path, entity_cache_path=entity_cache_path,
+                  metrics=metrics, quiet=quiet, source=source)
+        bot.run(force=False)
+        if neo4j_watermark_path and not simulate:
+            with open(neo4j_watermark_path, "w") as f:
+                f.write(str(started))
+    finally:
+        if source:
+            source.close()
+        if driver:
+            driver.close()
+        metrics.close()
 
 
 if __name__ == '__main__':
@@ -310,9 +943,35 @@ if __name__ == '__main__':
     p.add("--password", required=True, help="Wikibase password")
     p.add("--mediawiki_api_url", required=True, help="Wikibase mediawiki api url")
     p.add("--sparql_endpoint_url", required=True, help="Wikibase sparql endpoint url")
-    p.add("--node-path", required=True, help="path to neo4j nodes csv dump")
-    p.add("--edge-path", required=True, help="path to neo4j edges csv dump")
+    p.add("--node-path", help="path to neo4j nodes csv dump")
+    p.add("--edge-path", help="path to neo4j edges csv dump")
     p.add("--simulate", action='store_true', help="don't actually perform writes to Wikibase")
+    p.add("--state-path", help="path to the snapshot of the last synced nodes and edges. if given, only the "
+                               "nodes and edges that changed since the last run are written")
+    p.add("--concurrency", type=int, default=1, help="number of concurrent writes to Wikibase")
+    p.add("--rate-limit", type=float, help="maximum number of writes per second")
+    p.add("--chunksize", type=int, help="stream the nodes and edges csvs in chunks of this many rows instead of "
+                                        "loading them into memory")
+    p.add("--id-store-path", help="path to a sqlite file caching the id mappings between runs. only entities "
+                                  "modified since the last run are queried")
+    p.add("--journal-path", help="path to a progress journal. if a run crashes, running again with the same "
+                                 "journal and inputs resumes it")
+    p.add("--entity-cache-path", help="path to a sqlite file caching the claims of the items written, so unchanged "
+                                      "items are neither read nor written")
+    p.add("--metrics-path", help="write counters and timings of the run to this file")
+    p.add("--metrics-format", default="jsonl", choices=["jsonl", "prometheus"],
+          help="jsonl appends a snapshot per line. prometheus replaces the file with the latest snapshot")
+    p.add("--metrics-interval", type=float, default=60, help="seconds between metrics snapshots")
+    p.add("--quiet", action='store_true', help="no per item output or progress bars")
+    p.add("--neo4j-uri", help="read from this running neo4j (e.g. bolt://localhost:7687) instead of the csvs")
+    p.add("--neo4j-user", help="neo4j username")
+    p.add("--neo4j-password", help="neo4j password")
+    p.add("--neo4j-database", help="neo4j database, if not the default one")
+    p.add("--neo4j-page-size", type=int, default=10000, help="number of nodes per neo4j read")
+    p.add("--neo4j-modified-property", help="node and relationship property holding the time (in epoch "
+                                            "milliseconds, like timestamp()) they were last modified")
+    p.add("--neo4j-watermark-path", help="path to the time of the last successful run. if given, only the nodes and "
+                                         "subjects modified since then are synced")
     options, _ = p.parse_known_args()
     d = options.__dict__.copy()
     del d['config']
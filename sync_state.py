@@ -0,0 +1,160 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+node_hash_columns = ['id:ID', ':LABEL', 'preflabel', 'synonyms:IGNORE', 'name', 'description']
+edge_hash_columns = [':START_ID', ':TYPE', ':END_ID', 'reference_uri', 'reference_supporting_text', 'property_uri']
+
+
+def row_hash(values):
+    return hashlib.blake2b("\x1f".join(values).encode(), digest_size=8).hexdigest()
+
+
+class Snapshot:
+    """
+    Content hashes of the nodes and edges as they were last synced to the Wikibase
+    nodes: {curie: hash of the node row, or None for a node that was removed (its item is kept)}
+    edges: {subject curie: [hash of all of the subject's edge rows, [property uris used by the subject]]}
+    """
+
+    def __init__(self, nodes=None, edges=None):
+        self.nodes = nodes if nodes is not None else dict()
+        self.edges = edges if edges is not None else dict()
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return cls()
+        with gzip.open(path, "rt") as f:
+            d = json.load(f)
+        return cls(d['nodes'], d['edges'])
+
+    def save(self, path):
+        # write to a temp file and move it in place, so a crash never leaves a truncated snapshot behind
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, "wt") as f:
+            json.dump({'nodes': self.nodes, 'edges': self.edges}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def from_frames(cls, node_frames, edge_frames):
+        # node_frames, edge_frames: iterables of nodes and edges dataframes (e.g. the chunks of the csvs)
+        node_hashes = dict()
+        for nodes in node_frames:
+            node_hashes.update((row[0], row_hash(row)) for row in
+                               nodes[node_hash_columns].itertuples(index=False, name=None))
+
+        subj_rows = defaultdict(list)
+        subj_props = defaultdict(set)
+        for edges in edge_frames:
+            for row in edges[edge_hash_columns].itertuples(index=False, name=None):
+                subj_rows[row[0]].append(row_hash(row))
+                subj_props[row[0]].add(row[5])
+        # row order within a subject doesn't change what gets written
+        edge_hashes = {subj: [row_hash(sorted(hashes)), sorted(subj_props[subj])] for subj, hashes in
+                       subj_rows.items()}
+
+        return cls(node_hashes, edge_hashes)
+
+    def diff_nodes(self, new):
+        # returns (added, changed, removed) sets of curies. a removed node that comes back is changed, because its
+        # item still exists
+        added = {k for k in new.nodes if k not in self.nodes}
+        changed = {k for k, v in new.nodes.items() if k in self.nodes and self.nodes[k] != v}
+        removed = {k for k, v in self.nodes.items() if v is not None and k not in new.nodes}
+        return added, changed, removed
+
+    def diff_edges(self, new):
+        # returns (changed subjects, {subject: property uris that the subject no longer uses})
+        changed = {k for k, v in new.edges.items() if k not in self.edges or self.edges[k][0] != v[0]}
+        changed |= {k for k in self.edges if k not in new.edges}
+        removed_props = dict()
+        for subj in changed:
+            old_props = set(self.edges[subj][1]) if subj in self.edges else set()
+            new_props = set(new.edges[subj][1]) if subj in new.edges else set()
+            if old_props - new_props:
+                removed_props[subj] = old_props - new_props
+        return changed, removed_props
+
+
+class Journal:
+    """
+    Append-only log of the progress of a run, so a run that crashed can be resumed where it stopped.
+    One json list per line, flushed as it is written. The run, pending and minted records are fsync'd right away,
+    the stage and done records in groups of up to sync_every or sync_interval seconds: if the machine goes down,
+    the work of the last ones is done again. The records:
+    ["run", run_id]                                  inputs of the run. resuming with other inputs is refused
+    ["stage", stage]                                 the stage finished
+    ["done", stage, key]                             e.g. the edges of a subject were written
+    ["pending", prop, value, label, entity_type]     an entity is about to be created
+    ["minted", prop, value, id]                      the entity was created
+    A pending entity without a minted record may or may not have been created before the crash.
+    """
+    sync_every = 1000
+    sync_interval = 1
+
+    def __init__(self, path, run_id):
+        self.path = path
+        self.stages = set()
+        self.done = set()
+        self.pending = dict()
+        self.minted = dict()
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+        self.run_id = None
+        if os.path.exists(path):
+            good = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    # the last line can be cut off by the crash. it gets dropped
+                    if not line.endswith(b"\n"):
+                        break
+                    self.replay(json.loads(line.decode()))
+                    good += len(line)
+            with open(path, "r+b") as f:
+                f.truncate(good)
+            if self.run_id is not None and self.run_id != run_id:
+                raise ValueError("journal {} is from a run with other inputs. delete it to start over".format(path))
+            print("resuming run. finished stages: {}, done: {}, minted: {}".format(
+                sorted(self.stages), len(self.done), len(self.minted)))
+        self.f = open(path, "a")
+        if self.run_id is None:
+            self.run_id = run_id
+            self.append("run", run_id)
+
+    def replay(self, record):
+        kind, args = record[0], record[1:]
+        if kind == "run":
+            self.run_id = args[0]
+        elif kind == "stage":
+            self.stages.add(args[0])
+        elif kind == "done":
+            self.done.add(tuple(args))
+        elif kind == "pending":
+            self.pending[tuple(args[:2])] = tuple(args[2:])
+        elif kind == "minted":
+            self.pending.pop(tuple(args[:2]), None)
+            self.minted[tuple(args[:2])] = args[2]
+
+    def append(self, *record):
+        with self.lock:
+            self.f.write(json.dumps(record) + "\n")
+            self.f.flush()
+            self.unsynced += 1
+            # an entity must be on disk as pending before it's created, or it could be created twice
+            if (record[0] in ("stage", "done") and self.unsynced < self.sync_every and
+                    time.monotonic() - self.synced_at < self.sync_interval):
+                return
+            os.fsync(self.f.fileno())
+            self.unsynced = 0
+            self.synced_at = time.monotonic()
+
+    def remove(self):
+        # the run finished
+        self.f.close()
+        os.remove(self.path)
@@ -0,0 +1,102 @@
+import csv
+import os
+import sys
+import threading
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "benchmark"))
+
+from wikidataintegrator import wdi_core, wdi_login
+
+import fake_wikibase
+import generate
+import neo4j_to_wd
+import wd_to_neo4j
+
+# as in benchmark/run.py: the item engine looks up the distinct value properties and external id databases of
+# wikidata.org, none of which apply to the fake wikibase
+wdi_core.WDItemEngine.DISTINCT_VALUE_PROPS['https://query.wikidata.org/sparql'] = set()
+wdi_core.WDItemEngine.databases = {'none': []}
+
+
+class FlakyWikibase(fake_wikibase.FakeWikibase):
+    # fails some wbeditentity calls with maxlag (which wikidataintegrator retries) or an edit conflict (which the
+    # write pipeline retries), without applying them. counts the wbeditentity calls in n_edits
+    def __init__(self, errors):
+        super().__init__()
+        # {call number: error code}
+        self.errors = errors
+        self.n_edits = 0
+        self.edit_lock = threading.Lock()
+
+    def edit_entity(self, params):
+        with self.edit_lock:
+            self.n_edits += 1
+            code = self.errors.get(self.n_edits)
+        if code == 'maxlag':
+            return {'error': {'code': 'maxlag', 'info': 'lagged', 'lag': 0}}
+        if code:
+            return {'error': {'code': code, 'info': code}}
+        return super().edit_entity(params)
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    # wikidataintegrator writes its logs to ./logs
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.fixture
+def serve():
+    # serve(wikibase=None) serves a (bootstrapped) fake wikibase and returns (wikibase, api url, sparql url)
+    servers = []
+
+    def start(wikibase=None):
+        if wikibase is not None:
+            fake_wikibase.bootstrap(wikibase)
+        wikibase, server, api_url, sparql_url = fake_wikibase.serve(wikibase)
+        servers.append(server)
+        return wikibase, api_url, sparql_url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def graph(tmp_path):
+    # a small generated nodes and edges csv
+    node_path, edge_path = str(tmp_path / "nodes.csv"), str(tmp_path / "edges.csv")
+    generate.generate(node_path, edge_path, nodes=40, edges=120, seed=1)
+    return node_path, edge_path
+
+
+def write_graph(tmp_path, name, nodes, edges):
+    # writes the rows of nodes and edges to a nodes and an edges csv, and returns their paths
+    paths = str(tmp_path / (name + "_nodes.csv")), str(tmp_path / (name + "_edges.csv"))
+    for path, columns, rows in zip(paths, (wd_to_neo4j.Bot.node_columns, wd_to_neo4j.Bot.edge_columns),
+                                   (nodes, edges)):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(rows)
+    return paths
+
+
+def sync(graph, api_url, sparql_url, **kwargs):
+    login = wdi_login.WDLogin(user="test", pwd="test", mediawiki_api_url=api_url)
+    bot = neo4j_to_wd.Bot(graph[0], graph[1], api_url, sparql_url, login, quiet=True, **kwargs)
+    bot.run()
+    return bot
+
+
+def export(api_url, sparql_url, tmp_path, name, **kwargs):
+    # the sorted lines of the nodes and edges csvs exported by wd_to_neo4j
+    node_path, edge_path = str(tmp_path / (name + "_nodes.csv")), str(tmp_path / (name + "_edges.csv"))
+    wd_to_neo4j.Bot(sparql_url, api_url, node_path, edge_path, quiet=True, **kwargs).run()
+    with open(node_path) as f, open(edge_path) as g:
+        return sorted(f.read().splitlines()), sorted(g.read().splitlines())
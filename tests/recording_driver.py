@@ -0,0 +1,27 @@
+class RecordingDriver:
+    """
+    A stand-in for a neo4j driver that records the Cypher queries run on its sessions, as (query, parameters) in
+    queries. respond(query, parameters) gives the records a query returns, none by default.
+    """
+
+    def __init__(self, respond=None):
+        self.queries = []
+        self.respond = respond if respond else lambda query, parameters: []
+
+    def session(self, database=None):
+        return RecordingSession(self)
+
+    def close(self):
+        pass
+
+
+class RecordingSession:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def run(self, query, **parameters):
+        self.driver.queries.append((query, parameters))
+        return iter(self.driver.respond(query, parameters))
+
+    def close(self):
+        pass
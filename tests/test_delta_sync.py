@@ -0,0 +1,29 @@
+from conftest import export, sync, write_graph
+
+edges = [["X:1", "RO:0002000", "X:2", "http://example.org/ref", "", "", "relation 0", "",
+          "http://purl.obolibrary.org/obo/RO_0002000"]]
+
+
+def test_delta_sync_clears_removed_synonyms_and_descriptions(serve, tmp_path):
+    wikibase, api_url, sparql_url = serve()
+    state_path = str(tmp_path / "state.json.gz")
+    before = write_graph(tmp_path, "before", [
+        ["X:1", "gene", "alpha", "syn1|syn2", "alpha name", "a description"],
+        ["X:2", "gene", "beta", "", "beta name", "b description"],
+    ], edges)
+    sync(before, api_url, sparql_url, state_path=state_path)
+    nodes, _ = export(api_url, sparql_url, tmp_path, "before")
+    assert [x for x in nodes if x.startswith("X:1,")] == ["X:1,gene,alpha,alpha name|syn1|syn2,alpha,a description"]
+
+    after = write_graph(tmp_path, "after", [
+        ["X:1", "gene", "alpha", "", "alpha", ""],
+        ["X:2", "gene", "beta", "", "beta name", "b description"],
+    ], edges)
+    sync(after, api_url, sparql_url, state_path=state_path)
+    nodes, _ = export(api_url, sparql_url, tmp_path, "after")
+    assert [x for x in nodes if x.startswith("X:1,")] == ["X:1,gene,alpha,NA,alpha,NA"]
+
+    # nothing's left to repair
+    revisions = {eid: entity['lastrevid'] for eid, entity in wikibase.entities.items()}
+    sync(after, api_url, sparql_url, state_path=state_path)
+    assert {eid: entity['lastrevid'] for eid, entity in wikibase.entities.items()} == revisions
@@ -0,0 +1,87 @@
+from wikidataintegrator import wdi_core
+
+from conftest import FlakyWikibase, sync
+from entity_cache import diff_claims, snak_key
+
+
+def item_value(qid, with_id=True):
+    value = {'entity-type': 'item', 'numeric-id': int(qid[1:])}
+    if with_id:
+        value['id'] = qid
+    return {'type': 'wikibase-entityid', 'value': value}
+
+
+def snak(prop, datavalue, datatype):
+    return {'snaktype': 'value', 'property': prop, 'hash': "hash of " + prop, 'datavalue': datavalue,
+            'datatype': datatype}
+
+
+def reference(*texts, order=None):
+    # a reference of P7 supporting text chunks, with wikibase's snaks-order unless given one
+    snaks = [snak('P7', {'type': 'string', 'value': x}, 'string') for x in texts]
+    return {'hash': "a reference hash", 'snaks': {'P7': snaks}, 'snaks-order': order if order else ['P7']}
+
+
+def claim(claim_id, qid, references=(), with_id=True):
+    # a claim of P3 with the value qid, as wikibase returns it
+    return {'id': claim_id, 'type': 'statement', 'rank': 'normal',
+            'mainsnak': snak('P3', item_value(qid, with_id), 'wikibase-item'), 'references': list(references)}
+
+
+def statement(qid, *texts):
+    references = [[wdi_core.WDString(x, 'P7', is_reference=True) for x in texts]] if texts else None
+    return wdi_core.WDItemID(qid, 'P3', references=references)
+
+
+def test_same_statements_send_nothing():
+    claims = {'P3': [claim("Q1$1", "Q5", [reference("a")]), claim("Q1$2", "Q6")]}
+    assert diff_claims(claims, [statement("Q6"), statement("Q5", "a")]) == dict()
+
+
+def test_a_kept_value_gets_the_new_references():
+    claims = {'P3': [claim("Q1$1", "Q5", [reference("a")])]}
+    edits = diff_claims(claims, [statement("Q5", "b")])
+    assert [x['id'] for x in edits['P3']] == ["Q1$1"]
+    assert [snak_key(x) for x in edits['P3'][0]['references'][0]['snaks']['P7']] == [('P7', 'value', '"b"')]
+
+
+def test_a_removed_value_is_removed():
+    claims = {'P3': [claim("Q1$1", "Q5"), claim("Q1$2", "Q6")]}
+    edits = diff_claims(claims, [statement("Q6"), statement("Q7")])
+    assert edits['P3'][0] == {'id': "Q1$1", 'remove': ''}
+    assert len(edits['P3']) == 2
+    assert 'id' not in edits['P3'][1]
+    assert snak_key(edits['P3'][1]['mainsnak']) == snak_key(claim(None, "Q7")['mainsnak'])
+
+
+def test_delete_statement_removes_every_value():
+    claims = {'P3': [claim("Q1$1", "Q5"), claim("Q1$2", "Q6")], 'P4': [claim("Q1$3", "Q5")]}
+    edits = diff_claims(claims, [wdi_core.WDBaseDataType.delete_statement('P3')])
+    assert edits == {'P3': [{'id': "Q1$1", 'remove': ''}, {'id': "Q1$2", 'remove': ''}]}
+    # nothing to delete
+    assert diff_claims(dict(), [wdi_core.WDBaseDataType.delete_statement('P3')]) == dict()
+
+
+def test_snaks_order_repeats():
+    # an item engine gives a snaks-order with one entry per snak, wikibase one per property
+    claims = {'P3': [claim("Q1$1", "Q5", [reference("a", "b")])]}
+    assert statement("Q5", "a", "b").get_json_representation()['references'][0]['snaks-order'] == ['P7', 'P7']
+    assert diff_claims(claims, [statement("Q5", "a", "b")]) == dict()
+    # but the order of the snaks still counts
+    assert diff_claims(claims, [statement("Q5", "b", "a")])['P3'][0]['id'] == "Q1$1"
+
+
+def test_item_values_with_and_without_an_id():
+    assert snak_key(claim(None, "Q5")['mainsnak']) == snak_key(claim(None, "Q5", with_id=False)['mainsnak'])
+    claims = {'P3': [claim("Q1$1", "Q5", with_id=False)]}
+    assert diff_claims(claims, [statement("Q5")]) == dict()
+    assert diff_claims(claims, [statement("Q6")])['P3'][0] == {'id': "Q1$1", 'remove': ''}
+
+
+def test_a_second_sync_sends_no_edits(serve, graph, tmp_path):
+    for entity_cache_path in (None, str(tmp_path / "entities.sqlite")):
+        wikibase, api_url, sparql_url = serve(FlakyWikibase(dict()))
+        sync(graph, api_url, sparql_url, entity_cache_path=entity_cache_path)
+        edits = wikibase.n_edits
+        sync(graph, api_url, sparql_url, entity_cache_path=entity_cache_path)
+        assert wikibase.n_edits == edits
@@ -0,0 +1,80 @@
+import pickle
+import random
+
+import pytest
+
+from id_map import IdMap
+
+
+class Model:
+    # what an IdMap should behave like: a dict, whose inverse gives the value of each entity set last
+    def __init__(self, items=()):
+        self.values = dict()
+        self.order = []
+        for value, eid in items:
+            self[value] = eid
+
+    def __setitem__(self, value, eid):
+        if value in self.values:
+            self.order.remove(value)
+        self.values[value] = eid
+        self.order.append(value)
+
+    def __delitem__(self, value):
+        del self.values[value]
+        self.order.remove(value)
+
+    def inverse(self):
+        return {self.values[value]: value for value in self.order}
+
+
+def random_value(rng):
+    prefix = rng.choice(["UniProt:", "GO:", "http://purl.obolibrary.org/obo/", "http://example.org/x#", "", "é:"])
+    return prefix + rng.choice(["Q", "P", "", "X"]) + str(rng.randint(0, 300))
+
+
+def random_eid(rng):
+    # mostly Q and P ids, which go in the table, and a few others, which don't
+    return rng.choice(["Q", "Q", "P", "L", "Q0", "P-"]) + str(rng.randint(0, 60))
+
+
+def check(id_map, model):
+    assert len(id_map) == len(model.values)
+    assert dict(id_map.items()) == model.values
+    inverse = model.inverse()
+    assert dict(id_map.inverse().items()) == inverse
+    assert len(id_map.inverse()) == len(inverse)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_same_as_a_dict(seed, monkeypatch):
+    rng = random.Random(seed)
+    # compact every few changes
+    monkeypatch.setattr(IdMap, "min_compact", rng.choice([1, 4, 16, 1 << 16]))
+    items = [(random_value(rng), random_eid(rng)) for _ in range(rng.randint(0, 200))]
+    items = list(dict(items).items())
+    id_map, model = IdMap(items), Model(items)
+    check(id_map, model)
+    for step in range(400):
+        value = random_value(rng)
+        action = rng.random()
+        if action < 0.6:
+            eid = random_eid(rng)
+            id_map[value] = eid
+            model[value] = eid
+        elif action < 0.9:
+            if value in model.values:
+                del id_map[value]
+                del model[value]
+            else:
+                with pytest.raises(KeyError):
+                    del id_map[value]
+        else:
+            id_map = pickle.loads(pickle.dumps(id_map))
+        assert id_map.get(value) == model.values.get(value)
+        assert (value in id_map) == (value in model.values)
+        eid = random_eid(rng)
+        assert id_map.inverse().get(eid) == model.inverse().get(eid)
+        if step % 50 == 0:
+            check(id_map, model)
+    check(id_map, model)
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+import sync_state
+from sync_state import Journal
+
+
+@pytest.fixture
+def fsyncs(monkeypatch):
+    # the file descriptors fsync'd
+    fsyncs = []
+    monkeypatch.setattr(sync_state.os, "fsync", fsyncs.append)
+    return fsyncs
+
+
+def test_done_records_are_synced_in_groups(tmp_path, fsyncs, monkeypatch):
+    monkeypatch.setattr(Journal, "sync_every", 10)
+    monkeypatch.setattr(Journal, "sync_interval", 3600)
+    journal = Journal(str(tmp_path / "journal"), ["run"])
+    assert len(fsyncs) == 1
+    for n in range(25):
+        journal.append("done", "edges", "X:{}".format(n))
+    assert len(fsyncs) == 3
+    journal.append("stage", "edges")
+    assert len(fsyncs) == 3
+    # the records an entity's creation depends on are synced right away, with the ones before them
+    journal.append("pending", "P1", "X:1", "label", "item")
+    assert len(fsyncs) == 4
+    journal.append("minted", "P1", "X:1", "Q1")
+    assert len(fsyncs) == 5
+    journal.remove()
+
+
+def test_done_records_are_synced_after_the_interval(tmp_path, fsyncs, monkeypatch):
+    monkeypatch.setattr(Journal, "sync_interval", 0)
+    journal = Journal(str(tmp_path / "journal"), ["run"])
+    journal.append("done", "edges", "X:1")
+    journal.append("done", "edges", "X:2")
+    assert len(fsyncs) == 3
+    journal.remove()
+
+
+def test_resume_reads_the_records_not_synced_yet(tmp_path, fsyncs, monkeypatch):
+    monkeypatch.setattr(Journal, "sync_interval", 3600)
+    path = str(tmp_path / "journal")
+    journal = Journal(path, ["run"])
+    journal.append("done", "edges", "X:1")
+    journal.append("stage", "nodes")
+    journal.append("pending", "P1", "X:2", "label", "item")
+    journal.append("done", "edges", "X:3")
+    # a record cut off by the crash
+    with open(path, "a") as f:
+        f.write('["done", "edges", "X:')
+    resumed = Journal(path, ["run"])
+    assert resumed.done == {("edges", "X:1"), ("edges", "X:3")}
+    assert resumed.stages == {"nodes"}
+    assert resumed.pending == {("P1", "X:2"): ("label", "item")}
+    with open(path) as f:
+        assert not f.read().endswith("X:")
+    journal.f.close()
+    resumed.remove()
+    assert not os.path.exists(path)
@@ -0,0 +1,96 @@
+from neo4j_backend import Neo4jSink
+from recording_driver import RecordingDriver
+from sync_state import Snapshot
+
+
+def node(node_id, label, name):
+    return {'id:ID': node_id, ':LABEL': label, 'preflabel': name, 'synonyms:IGNORE': '', 'name': name,
+            'description': ''}
+
+
+def edge(start, rel, end):
+    return {':START_ID': start, ':TYPE': rel, ':END_ID': end, 'reference_uri': 'http://example.org/' + start,
+            'reference_supporting_text': '', 'reference_date': None, 'property_label': rel,
+            'property_uri': 'http://example.org/' + rel}
+
+
+def props(node_id, name):
+    return {'id': node_id, 'preflabel': name, 'name': name, 'description': 'NA'}
+
+
+def rel(start, end, rel_type="r1"):
+    return {'start': start, 'end': end, 'props': {
+        'reference_uri': 'http://example.org/' + start, 'reference_supporting_text': 'NA', 'reference_date': 'NA',
+        'property_label': rel_type, 'property_uri': 'http://example.org/' + rel_type}}
+
+
+def merge(label):
+    return 'UNWIND $rows AS row MERGE (n:`{}` {{id: row.id}}) SET n = row'.format(label)
+
+
+def index(label):
+    return 'CREATE INDEX IF NOT EXISTS FOR (n:`{}`) ON (n.id)'.format(label)
+
+
+def delete_rels(label):
+    return 'UNWIND $rows AS id MATCH (a:`{}` {{id: id}})-[r]->() DELETE r'.format(label)
+
+
+def create_rels(start_label, rel_type, end_label):
+    return ('UNWIND $rows AS row MATCH (a:`{}` {{id: row.start}}), (b:`{}` {{id: row.end}}) '
+            'CREATE (a)-[r:`{}`]->(b) SET r = row.props').format(start_label, end_label, rel_type)
+
+
+def calls(driver):
+    return [(query, params.get('rows')) for query, params in driver.queries]
+
+
+def test_two_runs(tmp_path):
+    state_path = str(tmp_path / "state.json.gz")
+
+    driver = RecordingDriver()
+    with Neo4jSink(driver, state_path=state_path) as sink:
+        sink.write("A", node("A", "gene", "a"), [edge("A", "r1", "B"), edge("A", "r2", "C")])
+        sink.write("B", node("B", "gene", "b"), [edge("B", "r1", "C")])
+        sink.write("C", node("C", "disease", "c"), [])
+    assert calls(driver) == [
+        (index("gene"), None),
+        (merge("gene"), [props("A", "a"), props("B", "b")]),
+        (index("disease"), None),
+        (merge("disease"), [props("C", "c")]),
+        (delete_rels("gene"), ["A", "B"]),
+        (delete_rels("disease"), ["C"]),
+        (create_rels("gene", "r1", "gene"), [rel("A", "B")]),
+        (create_rels("gene", "r2", "disease"), [rel("A", "C", "r2")]),
+        (create_rels("gene", "r1", "disease"), [rel("B", "C")]),
+    ]
+
+    # A becomes a protein and loses its edge to C, B is renamed, C is removed and D is new
+    def respond(query, params):
+        if "RETURN DISTINCT" in query:
+            return [{'start': 'A', 'end': 'C'}, {'start': 'B', 'end': 'C'}]
+        return []
+
+    driver = RecordingDriver(respond)
+    with Neo4jSink(driver, state_path=state_path) as sink:
+        sink.write("A", node("A", "protein", "a"), [edge("A", "r1", "B")])
+        sink.write("B", node("B", "gene", "b2"), [edge("B", "r1", "C")])
+        sink.write("D", node("D", "gene", "d"), [edge("D", "r1", "A")])
+    assert calls(driver) == [
+        ('UNWIND $rows AS id MATCH (n:`gene` {id: id}) REMOVE n:`gene` SET n:`protein`', ["A"]),
+        (index("protein"), None),
+        (merge("protein"), [props("A", "a")]),
+        (index("gene"), None),
+        (merge("gene"), [props("B", "b2"), props("D", "d")]),
+        ('UNWIND $rows AS id MATCH (a)-->(n:`disease` {id: id}) RETURN DISTINCT a.id AS start, n.id AS end', ["C"]),
+        ('UNWIND $rows AS id MATCH (n:`disease` {id: id}) DETACH DELETE n', ["C"]),
+        # B's edges didn't change, so they aren't rewritten, only their dangling end is remembered
+        (delete_rels("protein"), ["A"]),
+        (delete_rels("gene"), ["D"]),
+        (create_rels("protein", "r1", "gene"), [rel("A", "B")]),
+        (create_rels("gene", "r1", "protein"), [rel("D", "A")]),
+    ]
+    state = Snapshot.load(state_path)
+    assert state.nodes.keys() == {"A", "B", "D"}
+    assert state.edges["B"][1] == ["C"]
+    assert state.edges["A"][1] == []
@@ -0,0 +1,39 @@
+from wikidataintegrator import wdi_login
+
+import neo4j_to_wd
+from neo4j_backend import Neo4jSource
+from recording_driver import RecordingDriver
+
+nodes = [
+    {'id': "X:0", 'preflabel': "same", 'synonyms': None, 'name': "same", 'description': "d", 'modified': 1000},
+    {'id': "X:1", 'preflabel': "same", 'synonyms': None, 'name': "same", 'description': "d", 'modified': 2000},
+    {'id': "X:2", 'preflabel': "other", 'synonyms': None, 'name': "other", 'description': "d", 'modified': 2000},
+]
+
+
+def respond(query, params):
+    # a neo4j with the gene nodes, and no relationships
+    if query.startswith("CALL db.labels()"):
+        return [{'label': "gene"}]
+    if "OPTIONAL MATCH" in query:
+        return []
+    rows = [x for x in nodes if x['id'] > params['after'] and x['modified'] >= params.get('since', 0)]
+    return rows[:params['limit']]
+
+
+def test_duplicate_labels_are_found_among_all_the_nodes_with_a_watermark(serve):
+    driver = RecordingDriver(respond)
+    source = Neo4jSource(driver, page_size=2, modified_property="modified", since=1500)
+    assert [x[0] for x in source.node_rows("gene")] == ["X:1", "X:2"]
+
+    wikibase, api_url, sparql_url = serve()
+    login = wdi_login.WDLogin(user="test", pwd="test", mediawiki_api_url=api_url)
+    bot = neo4j_to_wd.Bot(None, None, api_url, sparql_url, login, quiet=True, source=source)
+    # the source's edges are sorted, so they aren't read before they're written
+    assert bot.edges_sorted
+    assert not [query for query, params in driver.queries if "OPTIONAL MATCH" in query]
+    # X:0 wasn't modified, but its label is still the same as X:1's
+    assert [x for nodes in bot.node_frames() for x in nodes[["id:ID", "preflabel"]].values.tolist()] == [
+        ["X:1", "same (X:1)"], ["X:2", "other"]]
+    label_queries = [params for query, params in driver.queries if "n.name AS name ORDER BY" in query]
+    assert label_queries and all('since' not in params for params in label_queries)
@@ -0,0 +1,68 @@
+import csv
+import random
+
+from conftest import export, sync, write_graph
+from neo4j_to_wd import Bot
+
+pubmed = "https://www.ncbi.nlm.nih.gov/pubmed/"
+
+
+def test_split_text_at_the_width():
+    assert Bot.split_text("aa bb", width=5) == ["aa bb"]
+    assert Bot.split_text("aa bb", width=4) == ["aa", "bb"]
+    assert Bot.split_text("aa bb cc", width=5) == ["aa bb", "cc"]
+    assert Bot.split_text("a" * 400) == ["a" * 400]
+    assert Bot.split_text("a" * 400 + " b") == ["a" * 400, "b"]
+    assert Bot.split_text("a" * 399 + " bb") == ["a" * 399, "bb"]
+    assert Bot.split_text("a b" + "c" * 398) == ["a", "b" + "c" * 398]
+
+
+def test_split_text_keeps_long_words_and_double_spaces():
+    # a word longer than the width is a chunk of its own, and a double space is never split at
+    assert Bot.split_text("a " + "b" * 401 + " c") == ["a", "b" * 401, "c"]
+    assert Bot.split_text("aa  bb", width=4) == ["aa  bb"]
+    assert Bot.split_text("aa  bb cc", width=4) == ["aa  bb", "cc"]
+    # wikibase strings can't hold line breaks or tabs, or leading and trailing whitespace
+    assert Bot.split_text(" aa\tbb\ncc ") == ["aa bb cc"]
+    assert Bot.split_text("") == []
+
+
+def test_split_text_joins_back():
+    rng = random.Random(1)
+    for _ in range(200):
+        words = ["x" * rng.randint(1, 120) for _ in range(rng.randint(1, 40))]
+        text = "".join(word + " " * rng.choice([1, 1, 1, 2]) for word in words).strip()
+        chunks = Bot.split_text(text, width=rng.randint(50, 400))
+        assert " ".join(chunks) == text
+        assert all(chunk == chunk.strip() for chunk in chunks)
+
+
+def test_references_round_trip(serve, tmp_path):
+    rng = random.Random(2)
+
+    def pubmed_url(n):
+        return pubmed + ",".join(str(rng.randint(10 ** 7, 10 ** 8 - 1)) for _ in range(n))
+
+    def text(n):
+        return " ".join("word{}".format(rng.randint(0, 9999)) + " " * rng.choice([0, 0, 0, 1]) for _ in range(n))
+
+    long_pubmed, short_pubmed, other_pubmed = pubmed_url(100), pubmed_url(3), pubmed_url(60)
+    assert len(long_pubmed) > 400 and len(other_pubmed) > 400
+    rel = ["RO:0002000", "relation 0", "", "http://purl.obolibrary.org/obo/RO_0002000"]
+    references = [
+        ("X:1", "X:2", long_pubmed + "|ISBN-13:9780306406157", text(150)),
+        ("X:1", "X:2", "ISBN-10:0306406152|" + short_pubmed, "a" * 450 + " tail"),
+        ("X:2", "X:3", long_pubmed + "|" + other_pubmed, "x  y " + text(100)),
+        ("X:3", "X:1", "http://example.org/ref", ""),
+    ]
+    nodes = [[x, "gene", x.lower(), "", x.lower(), ""] for x in ("X:1", "X:2", "X:3")]
+    edges = [[start, rel[0], end, uri, supporting_text, ""] + rel[1:]
+             for start, end, uri, supporting_text in references]
+    graph = write_graph(tmp_path, "graph", nodes, edges)
+
+    wikibase, api_url, sparql_url = serve()
+    sync(graph, api_url, sparql_url)
+    _, exported = export(api_url, sparql_url, tmp_path, "export")
+    exported = sorted((x[0], x[2], x[3], "" if x[4] == "NA" else x[4]) for x in csv.reader(exported)
+                      if x[0] != ":START_ID")
+    assert exported == sorted(references)
@@ -0,0 +1,56 @@
+import threading
+import time
+
+from more_itertools import chunked
+
+import fake_wikibase
+import wd_to_neo4j
+from conftest import export, sync
+
+
+class SlowWikibase(fake_wikibase.FakeWikibase):
+    # wbgetentities waits delays[first id] seconds, and records the first id of each reply as it's sent
+    def __init__(self):
+        super().__init__()
+        self.delays = dict()
+        self.replied = []
+        self.reply_lock = threading.Lock()
+
+    def get_entities(self, ids):
+        time.sleep(self.delays.get(ids[0], 0))
+        reply = super().get_entities(ids)
+        with self.reply_lock:
+            self.replied.append(ids[0])
+        return reply
+
+
+def test_item_chunker_keeps_the_order_of_chunks_that_come_back_out_of_order(serve, graph):
+    wikibase, api_url, sparql_url = serve(SlowWikibase())
+    sync(graph, api_url, sparql_url)
+    bot = wd_to_neo4j.Bot(sparql_url, api_url, None, None, chunk_size=3, fetch_workers=4, quiet=True)
+    chunks = list(chunked(bot.qids, 3))
+    # in each group of 4 chunks in flight, the first one is the slowest
+    wikibase.delays = {chunk[0]: 0.02 * (4 - n % 4) for n, chunk in enumerate(chunks)}
+    wikibase.replied.clear()
+
+    items = list(bot.item_chunker(bot.qids))
+    assert [x.wd_item_id for x in items] == bot.qids
+    assert wikibase.replied != [chunk[0] for chunk in chunks]
+    assert sorted(wikibase.replied) == sorted(chunk[0] for chunk in chunks)
+
+
+def test_item_chunker_skips_missing_items(serve, graph):
+    wikibase, api_url, sparql_url = serve()
+    sync(graph, api_url, sparql_url)
+    bot = wd_to_neo4j.Bot(sparql_url, api_url, None, None, chunk_size=2, fetch_workers=2, quiet=True)
+    qids = bot.qids[:3] + ["Q999999"] + bot.qids[3:5]
+    assert [x.wd_item_id for x in bot.item_chunker(qids)] == bot.qids[:5]
+
+
+def test_concurrent_fetches_give_the_same_export(serve, graph, tmp_path):
+    _, api_url, sparql_url = serve()
+    sync(graph, api_url, sparql_url)
+    one = export(api_url, sparql_url, tmp_path, "one", chunk_size=50, fetch_workers=1)
+    many = export(api_url, sparql_url, tmp_path, "many", chunk_size=4, fetch_workers=8)
+    assert one == many
+    assert len(one[0]) > 1 and len(one[1]) > 1
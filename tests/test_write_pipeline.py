@@ -0,0 +1,148 @@
+import threading
+import time
+import types
+
+import pytest
+import requests
+from wikidataintegrator import wdi_core
+
+import write_pipeline
+from conftest import FlakyWikibase, export, sync
+from metrics import Metrics
+from write_pipeline import WritePipeline
+
+
+def api_error(code):
+    return wdi_core.WDApiError({'error': {'code': code, 'info': code}})
+
+
+def counter(metrics, name):
+    return sum(x['value'] for x in metrics.snapshot()['counters'] if x['name'] == name)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # the backoffs of the pipeline, which doesn't actually sleep
+    sleeps = []
+    monkeypatch.setattr(write_pipeline, "time", types.SimpleNamespace(sleep=sleeps.append, monotonic=time.monotonic))
+    return sleeps
+
+
+def flaky(errors, result="done"):
+    # a task that raises each of errors in turn, and then returns result
+    attempts = []
+
+    def task():
+        attempts.append(1)
+        if len(attempts) <= len(errors):
+            raise errors[len(attempts) - 1]
+        return result
+
+    return task, attempts
+
+
+def test_retryable_errors_are_retried_with_backoff(sleeps):
+    metrics = Metrics("test")
+    pipeline = WritePipeline(backoff=2, metrics=metrics)
+    task, attempts = flaky([api_error('maxlag'), api_error('editconflict'), requests.exceptions.ConnectionError()])
+    future = pipeline.submit(task)
+    pipeline.close()
+    assert future.result() == "done"
+    assert len(attempts) == 4
+    assert sleeps == [1, 2, 4]
+    assert counter(metrics, "write_retries_total") == 3
+
+
+def test_gives_up_after_max_retries(sleeps):
+    pipeline = WritePipeline(max_retries=2)
+    task, attempts = flaky([api_error('editconflict')] * 5)
+    pipeline.submit(task)
+    with pytest.raises(wdi_core.WDApiError):
+        pipeline.join()
+    assert len(attempts) == 3
+
+
+def test_other_errors_are_not_retried(sleeps):
+    pipeline = WritePipeline()
+    task, attempts = flaky([api_error('badvalue')])
+    pipeline.submit(task)
+    with pytest.raises(wdi_core.WDApiError):
+        pipeline.join()
+    assert len(attempts) == 1
+    assert sleeps == []
+
+
+def test_rate_limit():
+    pipeline = WritePipeline(concurrency=4, rate_limit=50)
+    times = []
+
+    def write():
+        pipeline.rate_limiter.wait()
+        times.append(time.monotonic())
+
+    for _ in range(11):
+        pipeline.submit(write)
+    pipeline.close()
+    # 10 intervals of 1/50 s
+    assert max(times) - min(times) >= 0.19
+
+
+def test_tasks_that_dont_write_dont_wait_for_the_rate_limit():
+    pipeline = WritePipeline(concurrency=4, rate_limit=1)
+    start = time.monotonic()
+    for _ in range(11):
+        pipeline.submit(lambda: None)
+    pipeline.close()
+    assert time.monotonic() - start < 1
+
+
+def test_join_waits_for_the_stage():
+    # a stage's tasks all finish before join returns, and no more than concurrency of them run at once
+    pipeline = WritePipeline(concurrency=3)
+    lock = threading.Lock()
+    running, most_running, done = [0], [0], []
+
+    def task(n):
+        with lock:
+            running[0] += 1
+            most_running[0] = max(most_running[0], running[0])
+        time.sleep(0.01 * (n % 4))
+        with lock:
+            running[0] -= 1
+            done.append(n)
+
+    for n in range(20):
+        pipeline.submit(task, n)
+    pipeline.join()
+    assert sorted(done) == list(range(20))
+    pipeline.submit(lambda: done.append("next stage"))
+    pipeline.close()
+    assert done[-1] == "next stage"
+    assert most_running[0] <= 3
+
+
+def test_sync_retries_injected_errors(serve, graph, tmp_path):
+    # not in the 4 edits of bootstrap or the 5 initial properties, which Bot.__init__ creates outside the pipeline
+    errors = {n + 9: code for n, code in [(2, 'maxlag'), (5, 'editconflict'), (30, 'maxlag'), (50, 'editconflict'),
+                                         (70, 'editconflict')]}
+    wikibase, api_url, sparql_url = serve(FlakyWikibase(errors))
+    bot = sync(graph, api_url, sparql_url, concurrency=4)
+    assert wikibase.n_edits > max(errors)
+    assert counter(bot.metrics, "write_retries_total") == 3
+
+    _, clean_api_url, clean_sparql_url = serve()
+    sync(graph, clean_api_url, clean_sparql_url)
+    assert export(api_url, sparql_url, tmp_path, "flaky") == export(clean_api_url, clean_sparql_url, tmp_path, "clean")
+
+
+def test_resync_makes_no_edits_and_doesnt_wait(serve, graph, sleeps):
+    wikibase, api_url, sparql_url = serve(FlakyWikibase(dict()))
+    sync(graph, api_url, sparql_url, concurrency=4, rate_limit=20)
+    edits = wikibase.n_edits
+    sleeps.clear()
+    bot = sync(graph, api_url, sparql_url, concurrency=4, rate_limit=20)
+    assert wikibase.n_edits == edits
+    assert sleeps == []
+    # every item was found to exist before being submitted
+    items = [x for x in bot.metrics.snapshot()['counters'] if x['name'] == "items_total"]
+    assert [x['labels'] for x in items] == [{'result': "exists"}]
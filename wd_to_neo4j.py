@@ -1,53 +1,221 @@
+import bz2
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import configargparse
-import pandas as pd
+import requests
 from tqdm import tqdm
-from wikidataintegrator import wdi_core, wdi_helpers
+from wikidataintegrator import wdi_core, wdi_helpers, wdi_login
 from more_itertools import chunked
 
+from id_map import IdMap
+from id_store import IdStore
+from metrics import Metrics
+from neo4j_backend import Neo4jSink, connect
+from neo4j_to_wd import Bot as SyncBot
+
+
+class EntityItem:
+    """
+    The read only parts of a WDItemEngine that parse_node and handle_statement use, made straight from an entity's
+    json. Much cheaper than an item engine, which copies all statements and builds the claim json for writing.
+    """
+    datatypes = {x.DTYPE: x for x in wdi_core.WDBaseDataType.__subclasses__()}
+
+    def __init__(self, entity):
+        self.wd_item_id = entity['id']
+        self.entity = entity
+        self.statements = [self.datatypes[z['mainsnak']['datatype']].from_json(z)
+                           for claims in entity.get('claims', dict()).values() for z in claims]
+
+    def get_label(self, lang='en'):
+        return self.entity.get('labels', dict()).get(lang, dict()).get('value', '')
+
+    def get_description(self, lang='en'):
+        return self.entity.get('descriptions', dict()).get(lang, dict()).get('value', '')
+
+    def get_aliases(self, lang='en'):
+        return [x['value'] for x in self.entity.get('aliases', dict()).get(lang, [])]
+
+
+class RowWriter:
+    """
+    Writes dict rows to a csv (gzipped if the path ends with .gz) in a fixed column order. Missing and empty values
+    are written as NA. The file is written to path + ".tmp" and only moved to path when closed without an error.
+    Without header, the column names aren't written (for the part files of a sharded export).
+    """
+
+    def __init__(self, path, columns, header=True):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.columns = columns
+        opener = gzip.open if path.endswith(".gz") else open
+        self.f = opener(self.tmp_path, "wt", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.f, lineterminator="\n")
+        if header:
+            self.writer.writerow(columns)
+
+    def write(self, row):
+        self.writer.writerow(["NA" if row.get(c) is None or row.get(c) == '' else row[c] for c in self.columns])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.f.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+
 
 class Bot:
     edge_columns = [':START_ID', ':TYPE', ':END_ID', 'reference_uri', 'reference_supporting_text',
                     'reference_date', 'property_label', 'property_description:IGNORE', 'property_uri']
     node_columns = ['id:ID', ':LABEL', 'preflabel', 'synonyms:IGNORE', 'name', 'description']
 
-    def __init__(self, sparql_endpoint_url, mediawiki_api_url, node_out_path, edge_out_path):
+    def __init__(self, sparql_endpoint_url, mediawiki_api_url, node_out_path, edge_out_path, chunk_size=50,
+                 fetch_workers=4, login=None, dump_path=None, id_store_path=None, metrics=None, quiet=False,
+                 sink=None, processes=1):
+        # sink: a neo4j_backend.Neo4jSink to write the rows to instead of the csvs
+        self.sink = sink
+        # processes: number of processes exporting a range of the items each, see run_sharded
+        if processes > 1 and (sink or dump_path):
+            raise ValueError("a sharded export can only fetch the items and write csvs")
+        self.processes = processes
+        # counters and timers of the run, see metrics.py. quiet: no progress bar
+        self.metrics = metrics if metrics else Metrics("wd_to_neo4j")
+        self.quiet = quiet
         self.sparql_endpoint_url = sparql_endpoint_url
         self.mediawiki_api_url = mediawiki_api_url
         self.node_out_path = node_out_path
         self.edge_out_path = edge_out_path
+        # wbgetentities allows 50 ids per request, or 500 for logged in bots
+        max_chunk_size = 500 if login else 50
+        if not 0 < chunk_size <= max_chunk_size:
+            raise ValueError("chunk_size must be between 1 and {}".format(max_chunk_size))
+        self.chunk_size = chunk_size
+        self.fetch_workers = fetch_workers
+        self.session = self.make_session(login.get_session() if login else requests.Session())
+
+        self.id_store = IdStore(id_store_path, sparql_endpoint_url) if id_store_path else None
 
-        uri_pid = wdi_helpers.id_mapper("P2", endpoint=sparql_endpoint_url)
-        self.pid_uri = {v: k for k, v in uri_pid.items()}
-        dbxref_pid = uri_pid['http://www.geneontology.org/formats/oboInOwl#DbXref']
-        dbxref_qid = wdi_helpers.id_mapper(dbxref_pid, endpoint=sparql_endpoint_url)
-        self.qid_dbxref = {v: k for k, v in dbxref_qid.items()}
+        with self.metrics.timer("stage_seconds", stage="mappings"):
+            uri_pid = self.id_mapper("P2")
+            dbxref_qid = self.id_mapper(uri_pid['http://www.geneontology.org/formats/oboInOwl#DbXref'])
+        self.pid_uri = uri_pid.inverse()
+        self.qid_dbxref = dbxref_qid.inverse()
         self.ref_supp_text_pid = uri_pid["http://reference_supporting_text"]
         self.reference_uri_pid = uri_pid["http://www.wikidata.org/entity/P854"]
         self.type_pid = uri_pid["http://type"]
 
         # prop label and descriptions
         pids = {x for x in self.qid_dbxref if x.startswith("P")}
-        props = wdi_core.WDItemEngine.generate_item_instances(list(pids), mediawiki_api_url)
-        self.pid_label = {pid: item.get_label() for pid, item in props}
-        self.pid_descr = {pid: item.get_description() for pid, item in props}
+        with self.metrics.timer("stage_seconds", stage="property_labels"):
+            texts = self.id_store.get_texts(pids) if self.id_store else dict()
+            fetched = {item.wd_item_id: (item.get_label(), item.get_description()) for item in
+                       self.item_chunker(sorted(pids - set(texts)))}
+            if self.id_store:
+                self.id_store.set_texts(fetched)
+        texts.update(fetched)
+        self.pid_label = {pid: label for pid, (label, descr) in texts.items()}
+        self.pid_descr = {pid: descr for pid, (label, descr) in texts.items()}
 
         # get all items and all statements
-        qids = {x for x in self.qid_dbxref if x.startswith("Q")}
-        self.item_iter = self.item_chunker(sorted(list(qids)))
-        # self.item_iter = self.item_chunker(['Q94', "Q347"])
-
-        self.edge_lines = []
-        self.node_lines = []
-
-    def item_chunker(self, qids) -> wdi_core.WDItemEngine:
-        # iterate through item instances, getting 20 at a time
-        chunks = chunked(qids, 20)
-        for chunk in chunks:
-            items = wdi_core.WDItemEngine.generate_item_instances(chunk, mediawiki_api_url=self.mediawiki_api_url)
-            for item in items:
-                yield item[1]
-
-    def parse_node(self, item: wdi_core.WDItemEngine):
+        self.dump_path = dump_path
+        self.qids = sorted(x for x in self.qid_dbxref if x.startswith("Q"))
+
+    def __getstate__(self):
+        # what goes to a process pool worker: the mappings and settings. the session keeps only its cookies, and the
+        # metrics (which hold a lock), the id store and the sink stay behind
+        state = self.__dict__.copy()
+        state.update(session=self.session.cookies, metrics=None, id_store=None, sink=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.metrics = Metrics("wd_to_neo4j")
+        session = requests.Session()
+        session.cookies = state['session']
+        self.session = self.make_session(session)
+
+    def make_session(self, session):
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.fetch_workers)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        self.metrics.instrument(session)
+        return session
+
+    def items(self, qids=None):
+        # the items of the dump, or of qids (all of them by default) from the api
+        if self.dump_path:
+            return self.dump_items(self.dump_path)
+        return self.item_chunker(self.qids if qids is None else qids)
+
+    def id_mapper(self, prop):
+        if self.id_store:
+            return self.id_store.id_mapper(prop)
+        return IdMap(wdi_helpers.id_mapper(prop, endpoint=self.sparql_endpoint_url) or dict())
+
+    def item_chunker(self, qids) -> EntityItem:
+        # iterate through item instances, getting chunk_size at a time.
+        # up to fetch_workers chunks are requested concurrently ahead of the one being consumed.
+        # items are yielded in the same order as qids
+        chunks = chunked(qids, self.chunk_size)
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            in_flight = deque()
+            for chunk in chunks:
+                in_flight.append(executor.submit(self.fetch_items, chunk))
+                if len(in_flight) >= self.fetch_workers:
+                    yield from self.make_items(in_flight.popleft().result())
+            while in_flight:
+                yield from self.make_items(in_flight.popleft().result())
+
+    def fetch_items(self, qids):
+        params = {
+            'action': 'wbgetentities',
+            'ids': '|'.join(qids),
+            'format': 'json'
+        }
+        headers = {
+            'User-Agent': wdi_core.config['USER_AGENT_DEFAULT']
+        }
+        # retries on maxlag and connection errors
+        reply = wdi_core.WDItemEngine.mediawiki_api_call("GET", self.mediawiki_api_url, session=self.session,
+                                                         params=params, headers=headers)
+        entities = reply['entities']
+        return [entities[qid] for qid in qids if qid in entities and 'missing' not in entities[qid]]
+
+    @staticmethod
+    def make_items(entities):
+        # wdi's json parsing isn't thread safe, so items are made here and not in the fetching threads
+        for entity in entities:
+            yield EntityItem(entity)
+
+    @staticmethod
+    def read_dump(path):
+        # dumpJson.php writes a json array with one entity per line. the dump can be gzipped or bzipped
+        opener = {'.gz': gzip.open, '.bz2': bz2.open}.get(os.path.splitext(path)[1], open)
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip().rstrip(",")
+                if line in {"[", "]", ""}:
+                    continue
+                yield json.loads(line)
+
+    def dump_items(self, path):
+        # items in the dump order. entities without a DbXref (e.g. created after the last sparql update) are skipped
+        for entity in self.read_dump(path):
+            if entity['id'].startswith("Q") and entity['id'] in self.qid_dbxref:
+                yield EntityItem(entity)
+
+    def parse_node(self, item: EntityItem):
         type_statements = [s for s in item.statements if s.get_prop_nr() == self.type_pid]
         if len(type_statements) != 1:
             return None
@@ -69,24 +237,6 @@ class Bot:
             s = s[:idx1]
         return s
 
-    def write_out(self):
-        for line in self.edge_lines:
-          for key, value in line.items():
-            if type(value) is str and value == '':
-              line[key] = None
-        df_edges = pd.DataFrame(self.edge_lines)
-        df_edges['reference_date'] = None
-        df_edges = df_edges[self.edge_columns]
-        df_edges.fillna('NA').to_csv(self.edge_out_path, index=None)
-
-        for line in self.node_lines:
-          for key, value in line.items():
-            if type(value) is str and value == '':
-              line[key] = None
-        df_nodes = pd.DataFrame(self.node_lines)
-        df_nodes = df_nodes[self.node_columns]
-        df_nodes.fillna('NA').to_csv(self.node_out_path, index=None)
-
     def handle_statement(self, s, start_id):
         # if a statement has multiple refs, it will return multiple lines
         skip_statements = {
@@ -103,11 +253,11 @@ class Bot:
         line[':END_ID'] = self.qid_dbxref["Q" + str(s.get_value())] if s.data_type == "wikibase-item" else s.get_value()
         if s.references:
             for ref in s.references:
+                # chunks and urls come in the order create_statement_ref in neo4j_to_wd.py wrote them
                 ref_supp_text_statements = [x for x in ref if x.get_prop_nr() == self.ref_supp_text_pid]
                 ref_supp_text = " ".join([x.get_value() for x in ref_supp_text_statements])
                 reference_uri_statements = [x for x in ref if x.get_prop_nr() == self.reference_uri_pid]
-                reference_uri = "|".join([x.get_value() for x in reference_uri_statements])
-                # todo: rejoin split pubmed urls
+                reference_uri = "|".join(SyncBot.join_ref_urls([x.get_value() for x in reference_uri_statements]))
                 line['reference_supporting_text'] = ref_supp_text
                 line['reference_uri'] = reference_uri
                 edge_lines.append(line.copy())
@@ -115,29 +265,98 @@ class Bot:
             edge_lines.append(line.copy())
         return edge_lines
 
+    def item_rows(self, qids=None):
+        # yields (start id, node row or None, edge rows) for each item
+        for item in tqdm(self.items(qids), disable=self.quiet):
+            start_id = self.qid_dbxref[item.wd_item_id]
+            edge_rows = [line for s in item.statements for line in self.handle_statement(s, start_id)]
+            node_row = self.parse_node(item)
+            self.metrics.inc("items_total")
+            self.metrics.inc("node_rows_total", 1 if node_row else 0)
+            self.metrics.inc("edge_rows_total", len(edge_rows))
+            yield start_id, node_row, edge_rows
+
     def run(self):
+        # rows are written as the items come in. reference_date is never set, so it is always NA
+        with self.metrics.timer("stage_seconds", stage="export"):
+            if self.sink:
+                with self.sink:
+                    for start_id, node_row, edge_rows in self.item_rows():
+                        self.sink.write(start_id, node_row, edge_rows)
+                return
+            if self.processes > 1:
+                self.run_sharded()
+                return
+            with RowWriter(self.edge_out_path, self.edge_columns) as edge_writer, \
+                    RowWriter(self.node_out_path, self.node_columns) as node_writer:
+                self.write_rows(self.item_rows(), node_writer, edge_writer)
 
-        edge_lines = []
-        node_lines = []
-        for item in tqdm(self.item_iter):
-            sub_qid = item.wd_item_id
-            start_id = self.qid_dbxref[sub_qid]
-            for s in item.statements:
-                edge_lines.extend(self.handle_statement(s, start_id))
+    @staticmethod
+    def write_rows(rows, node_writer, edge_writer):
+        for start_id, node_row, edge_rows in rows:
+            for line in edge_rows:
+                edge_writer.write(line)
+            if node_row:
+                node_writer.write(node_row)
 
-            node_template = self.parse_node(item)
-            if node_template:
-                node_lines.append(node_template.copy())
+    def run_sharded(self):
+        # the sorted qids are split into one range per process. each process writes the rows of its range to
+        # headerless part files, which are then concatenated in order, so the csvs are the same as with one process
+        n = len(self.qids)
+        shards = [self.qids[k * n // self.processes:(k + 1) * n // self.processes] for k in range(self.processes)]
+        # the parts are next to the output, not in /tmp, as they are as big as it (uncompressed)
+        out_dir = os.path.dirname(os.path.abspath(self.edge_out_path))
+        with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+            parts = [(os.path.join(tmp_dir, "nodes{}.csv".format(k)), os.path.join(tmp_dir, "edges{}.csv".format(k)))
+                     for k in range(len(shards))]
+            with ProcessPoolExecutor(max_workers=self.processes) as executor:
+                futures = [executor.submit(export_shard, self, shard, node_part, edge_part)
+                           for shard, (node_part, edge_part) in zip(shards, parts)]
+                for future in futures:
+                    self.metrics.merge(future.result())
+            with RowWriter(self.edge_out_path, self.edge_columns) as edge_writer, \
+                    RowWriter(self.node_out_path, self.node_columns) as node_writer:
+                for node_part, edge_part in parts:
+                    for part, writer in ((edge_part, edge_writer), (node_part, node_writer)):
+                        with open(part, newline="", encoding="utf-8") as f:
+                            shutil.copyfileobj(f, writer.f)
 
-        self.edge_lines = edge_lines
-        self.node_lines = node_lines
 
-        self.write_out()
+def export_shard(bot, qids, node_path, edge_path):
+    # process pool worker of Bot.run_sharded. returns the worker's metrics, to be added to the main process's
+    bot.quiet = True
+    with RowWriter(edge_path, bot.edge_columns, header=False) as edge_writer, \
+            RowWriter(node_path, bot.node_columns, header=False) as node_writer:
+        bot.write_rows(bot.item_rows(qids), node_writer, edge_writer)
+    return bot.metrics.snapshot()
 
 
-def main(mediawiki_api_url, sparql_endpoint_url, node_out_path, edge_out_path):
-    bot = Bot(sparql_endpoint_url, mediawiki_api_url, node_out_path, edge_out_path)
-    bot.run()
+def main(mediawiki_api_url, sparql_endpoint_url, node_out_path=None, edge_out_path=None, chunk_size=50,
+         fetch_workers=4, user=None, password=None, dump_path=None, id_store_path=None, metrics_path=None,
+         metrics_format="jsonl", metrics_interval=60, quiet=False, neo4j_uri=None, neo4j_user=None,
+         neo4j_password=None, neo4j_database=None, neo4j_state_path=None, neo4j_batch_size=1000, processes=1):
+    if not (neo4j_uri or (node_out_path and edge_out_path)):
+        raise ValueError("either the csv output paths or a neo4j uri are needed")
+    # logging in is only needed for chunks of more than 50 items
+    login = None
+    if user and chunk_size > 50:
+        login = wdi_login.WDLogin(user=user, pwd=password, mediawiki_api_url=mediawiki_api_url)
+    metrics = Metrics("wd_to_neo4j", metrics_path, metrics_format, metrics_interval)
+    metrics.start()
+    driver = connect(neo4j_uri, neo4j_user, neo4j_password) if neo4j_uri else None
+    try:
+        sink = None
+        if driver:
+            sink = Neo4jSink(driver, state_path=neo4j_state_path, batch_size=neo4j_batch_size,
+                             database=neo4j_database, metrics=metrics)
+        bot = Bot(sparql_endpoint_url, mediawiki_api_url, node_out_path, edge_out_path, chunk_size=chunk_size,
+                  fetch_workers=fetch_workers, login=login, dump_path=dump_path, id_store_path=id_store_path,
+                  metrics=metrics, quiet=quiet, sink=sink, processes=processes)
+        bot.run()
+    finally:
+        if driver:
+            driver.close()
+        metrics.close()
 
 
 if __name__ == '__main__':
@@ -145,10 +364,35 @@ if __name__ == '__main__':
     p.add('-c', '--config', is_config_file=True, help='config file path')
     p.add("--mediawiki_api_url", required=True, help="Wikibase mediawiki api url")
     p.add("--sparql_endpoint_url", required=True, help="Wikibase sparql endpoint url")
-    p.add("--node-out-path", required=True, help="path to output neo4j nodes csv")
-    p.add("--edge-out-path", required=True, help="path to output neo4j edges csv")
+    p.add("--node-out-path", help="path to output neo4j nodes csv")
+    p.add("--edge-out-path", help="path to output neo4j edges csv")
+    p.add("--chunk-size", type=int, default=50,
+          help="number of items fetched per request. max 50, or 500 when logged in as a bot")
+    p.add("--fetch-workers", type=int, default=4, help="number of concurrent item fetch requests")
+    p.add("--processes", type=int, default=1, help="number of processes exporting a range of the items each, with "
+                                                   "their own fetch workers. csv output from the api only")
+    p.add("--dump-path", help="read the items from this Wikibase json dump (made with dumpJson.php, optionally "
+                               "gzipped or bzipped) instead of the api")
+    p.add("--id-store-path", help="path to a sqlite file caching the id mappings and property labels between "
+                                  "runs. only entities modified since the last run are queried")
+    p.add("--neo4j-uri", help="write to this running neo4j (e.g. bolt://localhost:7687) instead of the csvs")
+    p.add("--neo4j-user", help="neo4j username")
+    p.add("--neo4j-password", help="neo4j password")
+    p.add("--neo4j-database", help="neo4j database, if not the default one")
+    p.add("--neo4j-state-path", help="path to the state of the last neo4j write. if given, only what changed since "
+                                     "then is written, and nodes that are gone are deleted")
+    p.add("--neo4j-batch-size", type=int, default=1000, help="number of rows per neo4j write")
+    p.add("--metrics-path", help="write counters and timings of the run to this file")
+    p.add("--metrics-format", default="jsonl", choices=["jsonl", "prometheus"],
+          help="jsonl appends a snapshot per line. prometheus replaces the file with the latest snapshot")
+    p.add("--metrics-interval", type=float, default=60, help="seconds between metrics snapshots")
+    p.add("--quiet", action='store_true', help="no progress bar")
+    p.add("--user", help="Wikibase username. only used if chunk-size > 50")
+    p.add("--password", help="Wikibase password. only used if chunk-size > 50")
     options, _ = p.parse_known_args()
-    print(options)
+    # the options go to the logs, so without the passwords
+    print(configargparse.Namespace(**{k: "*****" if v and k.endswith("password") else v
+                                      for k, v in options.__dict__.items()}))
     d = options.__dict__.copy()
     del d['config']
     main(**d)
@@ -0,0 +1,98 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from wikidataintegrator import wdi_core
+
+# mediawiki api error codes worth trying again
+retry_error_codes = {'maxlag', 'editconflict', 'failed-save', 'readonly', 'ratelimited', 'actionthrottledtext'}
+
+
+def is_retryable(e):
+    if isinstance(e, wdi_core.WDApiError):
+        error = e.wd_error_msg.get('error', dict()) if isinstance(e.wd_error_msg, dict) else dict()
+        codes = {error.get('code')} | {x.get('name') for x in error.get('messages', [])}
+        return bool(codes & retry_error_codes)
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+class RateLimiter:
+    # spaces out calls so that there are at most `rate` per second
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        time.sleep(start - now)
+
+
+class WritePipeline:
+    """
+    Runs write tasks on a bounded pool of worker threads.
+    A task is a function that reads and writes one entity. If it raises a retryable error (maxlag, edit conflict,
+    connection error, ...) the whole task is run again after a backoff, so it re-reads the entity.
+    Call `join` at the end of a stage that later stages depend on (e.g. properties before nodes before edges).
+    Tasks call `rate_limiter.wait()` right before each write, so a task that finds nothing to write takes no slot.
+    """
+
+    def __init__(self, concurrency=1, rate_limit=None, max_retries=5, backoff=2, metrics=None):
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        # bounds the number of queued tasks, so submitting millions of tasks doesn't use unbounded memory
+        self.slots = threading.BoundedSemaphore(concurrency * 2)
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        # a metrics.Metrics to count retries in
+        self.metrics = metrics
+        self.futures = set()
+        self.lock = threading.Lock()
+
+    def submit(self, f, *args, **kwargs):
+        self.slots.acquire()
+        future = self.executor.submit(self.run_task, f, *args, **kwargs)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self.task_done)
+        return future
+
+    def task_done(self, future):
+        self.slots.release()
+        if future.exception() is None:
+            with self.lock:
+                self.futures.discard(future)
+
+    def run_task(self, f, *args, **kwargs):
+        for n in range(self.max_retries + 1):
+            try:
+                return f(*args, **kwargs)
+            except Exception as e:
+                if n == self.max_retries or not is_retryable(e):
+                    raise
+                sleep_sec = self.backoff ** n
+                if self.metrics:
+                    self.metrics.inc("write_retries_total", error=type(e).__name__)
+                print("{}: {}. retrying in {} seconds".format(type(e).__name__, e, sleep_sec))
+                time.sleep(sleep_sec)
+
+    def join(self):
+        # wait for all submitted tasks. raises the first error of a failed task
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures)
+        with self.lock:
+            self.futures.clear()
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+    def close(self):
+        self.join()
+        self.executor.shutdown()